@@ -6,9 +6,66 @@ BASE_PATH = Path(__file__).parent
 OS_NAME = platform.system()
 MAX_FUNCTION_CALL_DEPTH = 5
 NOW = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-SUMMARY_TRIGGER_CHAR_COUNT = 5000
 NUM_RECENT_MESSAGES_TO_KEEP = 5
 MASTER_MODEL="gpt-4.1-mini"
 SLAVE_MODEL="gpt-4.1-nano"
-DISTANCE_THRESHOLD = 0.5
-TOP_K = 3
\ No newline at end of file
+# Tokens a model gets to see: the window sent to MASTER_MODEL is summarized once it grows past
+# its budget, and the conversation handed to SLAVE_MODEL for summarizing is cut to fit its own
+CONTEXT_TOKEN_BUDGETS = {
+    MASTER_MODEL: 8000,
+    SLAVE_MODEL: 16000,
+}
+DISTANCE_THRESHOLD = 0.5 # squared L2 cutoff of RAG hits with openai embeddings
+LOCAL_DISTANCE_THRESHOLD = 1.2 # same for the local hashing embedder, its vectors are spread differently
+TOP_K = 3
+SESSION_CACHE_MAX_CHATS = 20 # chats kept hydrated in memory for instant switching
+SESSION_CACHE_MAX_TOKENS = 400000 # memory cap of the session cache, in context window tokens
+SESSION_CACHE_PREFILL = 5 # most recently modified chats hydrated at startup
+CALENDAR_CLEANUP_INTERVAL = 3600 # seconds between removals of past calendar events
+SPOTIFY_PAGE_CONCURRENCY = 4 # pages of a playlist/album fetched at once
+SPOTIFY_QUEUE_CONCURRENCY = 4 # add-to-queue requests at once, when the order doesn't matter
+SPOTIFY_MAX_RETRIES = 5 # retries of a rate limited (429) Spotify request
+RAG_OVERFETCH = 3 # extra hits fetched so duplicates can be dropped and still fill TOP_K
+RAG_VECTOR_TIMEOUT = 2.0 # seconds to wait for vector search before answering from FTS alone
+RAG_VECTOR_COOLDOWN = 30 # seconds to skip vector search after it failed or timed out
+RRF_K = 60 # reciprocal rank fusion constant for merging vector and FTS hits
+RAG_FTS_CANDIDATES = 20 # FTS hits checked against the relevance gate below
+RAG_FTS_MIN_TERMS = 2 # query words an FTS hit must contain, unless it matches an identifier (path, code, uri...)
+RAG_FTS_MIN_COVERAGE = 0.5 # and at least this share of the query words
+STREAM_RESPONSES = True
+MAX_PARALLEL_TOOL_CALLS = 4
+TOOL_RELOAD_DEBOUNCE = 0.3 # seconds without file events in tools/ before changed tools are reloaded
+TOOL_CACHE_MAX_ENTRIES = 256 # results kept in memory by tools declared with cache_ttl
+
+# Shared HTTP client used by tools (http_client.py)
+HTTP_CONNECT_TIMEOUT = 3.05 # seconds
+HTTP_READ_TIMEOUT = 10 # seconds between bytes received
+HTTP_TOTAL_TIMEOUT = 30 # seconds for a whole request: connecting, retries and reading the body
+HTTP_MAX_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.5 # retries wait 0.5s, 1s, 2s...
+HTTP_MAX_RETRY_AFTER = 10 # seconds, a longer Retry-After fails the request instead of waiting
+HTTP_POOL_HOSTS = 16 # hosts with a pool of kept alive connections
+HTTP_POOL_SIZE = 8 # kept alive connections per host
+HTTP_REQUEST_THREADS = 16 # requests in flight at once, including ones abandoned at their deadline
+HTTP_MAX_RESPONSE_BYTES = 5 * 1024 * 1024
+
+WEB_FETCH_MAX_URLS = 8 # urls per web_fetch_pages call
+WEB_FETCH_MAX_CONCURRENCY = 4
+WEB_FETCH_DEADLINE = 15 # seconds for each page of web_fetch_pages
+
+# In-memory index of the workspace (workspace_index.py)
+WORKSPACE_TREE_MAX_LINES = 400 # lines of a directory_tree before it is cut
+WORKSPACE_FIND_MAX_RESULTS = 50 # paths returned by find_files
+WORKSPACE_SEARCH_MAX_RESULTS = 100 # matching lines returned by search_files
+WORKSPACE_INDEX_MAX_FILE_BYTES = 1024 * 1024 # larger files aren't content searched
+WORKSPACE_INDEX_MAX_FILES = 20000 # files past this aren't indexed at all
+WORKSPACE_INDEX_MAX_TOTAL_BYTES = 64 * 1024 * 1024 # text kept under the trigram index
+EMBEDDER = "openai" # "openai" or "local" (offline hashing embedder, see storage/embedders.py)
+EMBEDDING_MODEL = "text-embedding-3-small" # used by the openai embedder
+LOCAL_EMBEDDING_DIM = 384 # used by the local embedder
+EMBED_BATCH_SIZE = 32
+EMBED_BATCH_MAX_CHARS = 50000
+EMBED_BATCH_WINDOW = 0.5 # seconds
+EMBED_QUEUE_SIZE = 256
+EMBED_MAX_RETRIES = 3
+EMBED_CACHE_MAX_ENTRIES = 50000
@@ -0,0 +1,109 @@
+from config import CONTEXT_TOKEN_BUDGETS, MASTER_MODEL
+
+# Token accounting for the context window.
+#
+# MessageWindow is the list used for state.messages. It keeps a running token count that is
+# updated when messages are added or removed, so checking the window against a model's budget
+# costs the same no matter how long the chat is.
+
+_encoding = None
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            try:
+                _encoding = tiktoken.encoding_for_model(MASTER_MODEL)
+            except KeyError:
+                _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # tiktoken missing, or its BPE file can't be downloaded (offline), estimate instead
+            _encoding = False
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def _get(msg, key):
+    if isinstance(msg, dict):
+        return msg.get(key)
+    return getattr(msg, key, None)
+
+# Tokens a message takes up in a request, including tool calls and the per message overhead
+def count_message_tokens(msg) -> int:
+    content = _get(msg, "content")
+    if content is not None and not isinstance(content, str):
+        content = str(content)
+
+    tokens = 3 + count_tokens(_get(msg, "role")) + count_tokens(content)
+
+    for call in _get(msg, "tool_calls") or []:
+        function = _get(call, "function")
+        tokens += 3 + count_tokens(_get(function, "name")) + count_tokens(_get(function, "arguments"))
+
+    return tokens
+
+def token_budget(model: str) -> int:
+    return CONTEXT_TOKEN_BUDGETS[model]
+
+class MessageWindow(list):
+    def __init__(self, messages=()):
+        super().__init__(messages)
+        self.tokens = sum(count_message_tokens(m) for m in self)
+
+    def append(self, msg):
+        super().append(msg)
+        self.tokens += count_message_tokens(msg)
+
+    def extend(self, messages):
+        messages = list(messages)
+        super().extend(messages)
+        self.tokens += sum(count_message_tokens(m) for m in messages)
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def insert(self, index, msg):
+        super().insert(index, msg)
+        self.tokens += count_message_tokens(msg)
+
+    def pop(self, index=-1):
+        msg = super().pop(index)
+        self.tokens -= count_message_tokens(msg)
+        return msg
+
+    def remove(self, msg):
+        super().remove(msg)
+        self.tokens -= count_message_tokens(msg)
+
+    def clear(self):
+        super().clear()
+        self.tokens = 0
+
+    def __setitem__(self, index, value):
+        old = self[index]
+        if isinstance(index, slice):
+            value = list(value)
+        super().__setitem__(index, value)
+        if isinstance(index, slice):
+            self.tokens += sum(count_message_tokens(m) for m in value) - sum(count_message_tokens(m) for m in old)
+        else:
+            self.tokens += count_message_tokens(value) - count_message_tokens(old)
+
+    def __delitem__(self, index):
+        old = self[index]
+        super().__delitem__(index)
+        if isinstance(index, slice):
+            self.tokens -= sum(count_message_tokens(m) for m in old)
+        else:
+            self.tokens -= count_message_tokens(old)
+
+    def over_budget(self, model: str = MASTER_MODEL) -> bool:
+        return self.tokens > token_budget(model)
@@ -0,0 +1,112 @@
+import codecs
+import re
+from html.parser import HTMLParser
+
+# Streaming extraction of readable text from HTML, used by web_fetch_page.
+#
+# The page is fed to html.parser chunk by chunk as it downloads, nothing keeps a document tree.
+# Text is collected per block element (p, li, h1...), so text nested in several elements is emitted
+# once. Boilerplate elements (script, nav, footer...) are skipped along with everything inside them,
+# and lines that look like UI chrome or repeat an earlier line are dropped. Extraction stops as soon
+# as max_chars of text is collected, so the rest of the page is never downloaded or parsed.
+
+# Skipped with everything inside them
+SKIP_TAGS = {"script", "style", "noscript", "header", "footer", "nav", "aside", "svg", "template", "iframe", "button", "select"}
+# Start a new line of text
+BLOCK_TAGS = {
+    "p", "div", "li", "ul", "ol", "dl", "dt", "dd", "h1", "h2", "h3", "h4", "h5", "h6", "br", "hr",
+    "article", "section", "main", "blockquote", "pre", "table", "tr", "td", "th", "caption",
+    "figure", "figcaption", "title", "summary", "details", "body",
+}
+JUNK = re.compile(r'\b(menu|close|copy link|embed|embedded|share|copyright|login|log in|subscribe|cookie|advertis|terms|privacy)\b', re.IGNORECASE)
+WHITESPACE = re.compile(r"\s+")
+
+class TextExtractor(HTMLParser):
+    def __init__(self, max_chars: int):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.lines = []
+        self.chars = 0
+        self.seen = set()
+        self.skip_depth = 0
+        self.buffer = [] # text of the block being read
+        self.buffered = 0
+        self.href = None # set while inside a link
+        self.link_start = 0 # self.buffered when the link opened
+
+    @property
+    def done(self) -> bool:
+        return self.chars >= self.max_chars
+
+    def flush(self):
+        text = WHITESPACE.sub(" ", "".join(self.buffer)).strip()
+        self.buffer.clear()
+        self.buffered = 0
+        if not text or text in self.seen or JUNK.search(text):
+            return
+        self.seen.add(text)
+        self.lines.append(text)
+        self.chars += len(text) + 1
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif self.skip_depth:
+            return
+        elif tag in BLOCK_TAGS:
+            self.flush()
+        elif tag == "a":
+            self.href = dict(attrs).get("href")
+            self.link_start = self.buffered
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif self.skip_depth:
+            return
+        elif tag in BLOCK_TAGS:
+            self.flush()
+        elif tag == "a" and self.href is not None:
+            # Links keep their target inline, like "text (href)"
+            if self.buffered > self.link_start:
+                self.buffer.append(f" ({self.href})")
+            self.href = None
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        self.buffer.append(data)
+        self.buffered += len(data)
+        # A huge block without any tags is cut into lines instead of held in memory
+        if self.buffered > self.max_chars:
+            self.flush()
+
+    def text(self) -> str:
+        return "\n".join(self.lines)[:self.max_chars]
+
+# Charset from the Content-Type header, utf-8 when there's none
+def header_encoding(content_type: str) -> str:
+    match = re.search(r"charset=[\"']?([\w.:-]+)", content_type or "", re.IGNORECASE)
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return "utf-8"
+
+# Extracts up to max_chars of text from an iterable of raw HTML chunks. Stops pulling chunks as soon
+# as enough text is collected.
+def extract_text(chunks, max_chars: int, encoding: str = "utf-8") -> str:
+    extractor = TextExtractor(max_chars)
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+
+    for chunk in chunks:
+        extractor.feed(decoder.decode(chunk))
+        if extractor.done:
+            break
+    else:
+        extractor.feed(decoder.decode(b"", final=True))
+        extractor.close()
+        extractor.flush()
+
+    return extractor.text()
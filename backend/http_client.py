@@ -0,0 +1,150 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import DecodeError, MaxRetryError, ProtocolError, ReadTimeoutError, SSLError
+from urllib3.util.retry import Retry
+
+from config import HTTP_BACKOFF_FACTOR, HTTP_CONNECT_TIMEOUT, HTTP_MAX_RESPONSE_BYTES, HTTP_MAX_RETRIES, HTTP_MAX_RETRY_AFTER, HTTP_POOL_HOSTS, HTTP_POOL_SIZE, HTTP_READ_TIMEOUT, HTTP_REQUEST_THREADS, HTTP_TOTAL_TIMEOUT
+
+# Shared HTTP client for tools.
+#
+# One requests.Session for the whole backend, so connections (and TLS sessions) to a host are kept
+# alive and reused across tool calls instead of being opened for every request. Every request gets
+# connect/read timeouts and an overall deadline, idempotent requests are retried with exponential
+# backoff on connection errors and 429/5xx (honoring a Retry-After of up to HTTP_MAX_RETRY_AFTER),
+# and bodies are read up to HTTP_MAX_RESPONSE_BYTES, so a stalled or huge response can't hang a turn.
+
+TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+CHUNK_SIZE = 64 * 1024
+FALLBACK_CHUNK_SIZE = 4 * 1024 # Without read1, see _read_pieces
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+SERVER_ERRORS = (500, 502, 503, 504)
+
+class ResponseTooLarge(requests.RequestException):
+    pass
+
+# Doesn't retry when the server asks to wait longer than HTTP_MAX_RETRY_AFTER, the response is
+# returned as is (raise_on_status is off) instead of blocking the turn
+class CappedRetry(Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and self.respect_retry_after_header:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None and retry_after > HTTP_MAX_RETRY_AFTER:
+                raise MaxRetryError(_pool, url, f"Retry-After of {retry_after:.0f}s")
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+# Clients that handle rate limits themselves (spotify.py) build their own session without 429
+def build_session(status_forcelist=RETRY_STATUSES):
+    retry = CappedRetry(
+        total=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=status_forcelist,
+        allowed_methods=frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}),
+        respect_retry_after_header=True,
+        raise_on_status=False # The last response is returned, raise_for_status() reports it
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+session = build_session()
+
+# Runs session.request so waiting for it can be abandoned at the deadline. Connecting, the wait for
+# headers and retries (with their backoff) happen inside it and are only bounded per attempt.
+request_executor = ThreadPoolExecutor(max_workers=HTTP_REQUEST_THREADS)
+
+def _close_abandoned(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+# Opens a request without reading the body, for callers that consume it with iter_chunks and may
+# stop early. The whole call, from connecting to iter_chunks reading the last byte, gives up once
+# deadline seconds have passed. The response is closed when the block exits.
+@contextmanager
+def stream(method: str, url: str, timeout=TIMEOUT, deadline: float = HTTP_TOTAL_TIMEOUT, **kwargs):
+    started = time.monotonic()
+    future = request_executor.submit(session.request, method, url, timeout=timeout, stream=True, **kwargs)
+    try:
+        response = future.result(timeout=deadline)
+    except TimeoutError:
+        # The request carries on in its thread until its own timeouts, its response is dropped
+        future.add_done_callback(_close_abandoned)
+        raise requests.Timeout(f"No response from {url} within {deadline}s")
+    response.deadline = started + deadline
+    try:
+        yield response
+    finally:
+        response.close()
+
+# Yields the decompressed body as it arrives, at most chunk_size bytes at a time. Every read returns
+# what a single socket read got instead of waiting for a full chunk, and the socket timeout is
+# lowered to the time left, so a host trickling bytes can't keep us past response.deadline.
+def _read_pieces(response: requests.Response, chunk_size: int):
+    url = response.url
+    raw = response.raw
+    sock = getattr(getattr(raw, "_connection", None), "sock", None)
+    if hasattr(raw, "read1"):
+        pieces = iter(lambda: raw.read1(chunk_size, decode_content=True), b"")
+    else:
+        # urllib3 before 2.1 has no read1. stream() waits for whole chunks, so the deadline is only
+        # checked between them: small chunks keep a trickle from holding us much past it.
+        pieces = raw.stream(min(chunk_size, FALLBACK_CHUNK_SIZE), decode_content=True)
+    try:
+        while True:
+            remaining = response.deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.Timeout(f"Reading the response from {url} took too long", response=response)
+            if sock is not None:
+                sock.settimeout(min(HTTP_READ_TIMEOUT, remaining))
+
+            piece = next(pieces, b"")
+            if not piece:
+                return
+            yield piece
+    # The same translation iter_content does
+    except ReadTimeoutError as e:
+        raise requests.Timeout(f"Reading the response from {url} took too long: {e}", response=response)
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e, response=response)
+    except DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e, response=response)
+    except SSLError as e:
+        raise requests.exceptions.SSLError(e, response=response)
+
+# Yields the body of a streamed response in chunks, up to max_bytes. Past that it raises
+# ResponseTooLarge, or just stops when truncate is set.
+def iter_chunks(response: requests.Response, max_bytes: int = HTTP_MAX_RESPONSE_BYTES, truncate: bool = False, chunk_size: int = CHUNK_SIZE):
+    url = response.url
+    length = response.headers.get("Content-Length")
+    if not truncate and length and length.isdigit() and int(length) > max_bytes:
+        raise ResponseTooLarge(f"Response from {url} is {length} bytes, limit is {max_bytes}", response=response)
+
+    size = 0
+    # Pieces are decompressed, so the limit applies to what we actually hold in memory
+    for chunk in _read_pieces(response, chunk_size):
+        size += len(chunk)
+        if size > max_bytes:
+            if not truncate:
+                raise ResponseTooLarge(f"Response from {url} is over the {max_bytes} byte limit", response=response)
+            yield chunk[:len(chunk) - (size - max_bytes)]
+            return
+        yield chunk
+
+# Like session.request, with default timeouts and a size limit on the body. Bodies over max_bytes
+# raise ResponseTooLarge, or are cut at max_bytes when truncate is set.
+def request(method: str, url: str, max_bytes: int = HTTP_MAX_RESPONSE_BYTES, truncate: bool = False, **kwargs) -> requests.Response:
+    with stream(method, url, **kwargs) as response:
+        response._content = b"".join(iter_chunks(response, max_bytes, truncate))
+    return response
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
@@ -1,29 +1,46 @@
 from openai import OpenAI
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
 from dotenv import load_dotenv, find_dotenv
 from pathlib import Path
 import sys
 import os
 import json
 import io
-from config import DISTANCE_THRESHOLD, MASTER_MODEL, MAX_FUNCTION_CALL_DEPTH, NUM_RECENT_MESSAGES_TO_KEEP, OS_NAME, NOW, SLAVE_MODEL, SUMMARY_TRIGGER_CHAR_COUNT, TOP_K
+import signal
+from config import MASTER_MODEL, MAX_FUNCTION_CALL_DEPTH, MAX_PARALLEL_TOOL_CALLS, NUM_RECENT_MESSAGES_TO_KEEP, OS_NAME, NOW, SESSION_CACHE_PREFILL, SLAVE_MODEL, STREAM_RESPONSES, TOP_K
 import json
-from state import tool_definitions, tool_functions
+from state import tool_definitions, tool_functions, tool_parallel_safe, tools_lock
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from watcher import start_file_watcher, load_tools
 from uprint import OutGoingDataType, uprint
-from storage.chat_storage import delete_chat, init_db, create_chat, insert_message, get_chat_messages, get_latest_chat_id, get_chats, query_embeddings, rename_chat, save_chat_window, load_chat_window
+from storage.db import write_batch
+from storage.chat_storage import delete_chat, forget_chat_window, init_db, create_chat, insert_message, get_chat_messages, get_latest_chat_id, get_chats, query_messages, rename_chat, save_chat_window, load_chat_window
+from session_cache import SessionCache
+from context_budget import MessageWindow, count_tokens, token_budget
 import state
 
+tool_executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_TOOL_CALLS)
+summary_executor = ThreadPoolExecutor(max_workers=1)
+pending_summaries = {} # chat id -> (window, snapshot of the window, Future of the summarized window)
 
+# A chat leaving the session cache takes its window tracking and unfinished summary with it
+def evict_session(chat_id):
+    forget_chat_window(chat_id)
+    pending_summaries.pop(chat_id, None)
+
+sessions = SessionCache(on_evict=evict_session)
 
 system_prompt = f"""
 You are Buddy, an intelligent, resourceful assistant with access to tools and memory. Your goal is to help the user accomplish tasks efficiently and independently, using available tools and your own reasoning.
 
 You have access to the entire workspace, including:
 - All files and directories (printed via the `directory_tree`), `read_file`, and `write_file` tools. This includes `main.py`, `config.py`, and the `tools/` directory.
-- The `storage` directory contains persistent storage for some tools, such as a reminders and calendar json
+- The `storage` directory contains persistent storage for some tools. Calendar events and the index of the user's Spotify playlists are stored in `chat_memory.db`
 - The `tools/` directory contains Python files defining callable tools. These tools are automatically injected into your API calls and can be used to perform actions such as file I/O, command execution, and web access.
 - You may create new tools at any time by writing Python functions to files within the `tools/` directory. Each function must be decorated with `@tool("...")` and include a clear, descriptive string explaining its purpose.
+- If a new tool modifies files or other shared state, declare it with `@tool("...", parallel_safe=False)` so it is never run at the same time as other tool calls.
 - You must declare the **type of each parameter** in the function signature to ensure it is usable via the function calling interface. For example:
 
 @tool("Generates a directory tree for the given path")
@@ -36,7 +53,7 @@ def directory_tree(path: str = ".", depth: int = 2):
 - **Avoid asking the user to repeat themselves** if you can deduce their goal or continue from previous context.
 - Only ask questions if something is truly ambiguous or needs clarification before continuing.
 - Avoid repeating tool names in explanations unless requested. Focus on delivering the result.
-- Before accessing or modifying the workspace, consider using `directory_tree` to list existing files.
+- Before accessing or modifying the workspace, consider using `directory_tree` to list existing files, or `find_files` and `search_files` to locate files by name or contents.
 
 ### Constraints:
 - Never delete, remove, overwrite, or modify the contents of: `main.py`, `config.py`, `tools_state.py`, `tool_decorator.py`, `watcher.py`, or `.env`.
@@ -79,7 +96,9 @@ def update_env_file(key: str, value: str, path: str):
 
 
 # This code is so cooked I need to fix this later...
-def summarize_messages(client: OpenAI):
+# Returns the summarized window for messages, or messages itself if there is nothing to summarize.
+# Runs on the summary worker against a snapshot, so it must not touch state.messages.
+def summarize_messages(messages):
     # Strip system prompts and keep last N messages
 
     # Context layout:
@@ -133,12 +152,12 @@ def summarize_messages(client: OpenAI):
             return msg.get("content")
         return getattr(msg, "content", None)
     
-    normalized_messages = [norm for m in state.messages if (norm := normalize_for_summary(m))]
+    normalized_messages = [norm for m in messages if (norm := normalize_for_summary(m))]
     
     to_summarize = normalized_messages[:-NUM_RECENT_MESSAGES_TO_KEEP]
 
     recent = [
-        norm for m in state.messages[-NUM_RECENT_MESSAGES_TO_KEEP:] 
+        norm for m in messages[-NUM_RECENT_MESSAGES_TO_KEEP:] 
         if (norm := normalize_for_recent(m))
     ]
 
@@ -146,12 +165,11 @@ def summarize_messages(client: OpenAI):
     if recent and get_role(recent[0]) == "tool":
         recent.pop(0)
 
-    # Count characters
-    char_count = sum(len(m["content"]) for m in to_summarize)
-    if char_count < SUMMARY_TRIGGER_CHAR_COUNT:
-        return state.messages  # Sliding window of conversation is too short to be summarized
+    # Only the recent messages are left (e.g. they hold large tool returns), summarizing won't shrink anything
+    if not to_summarize:
+        return messages
 
-    previous_summary = next((m for m in reversed(state.messages) 
+    previous_summary = next((m for m in reversed(messages) 
         if get_role(m) == "system" and "[SUMMARY OF PREVIOUS CONTEXT]" in get_content(m)),
         None
     )
@@ -185,11 +203,16 @@ def summarize_messages(client: OpenAI):
     if previous_summary:
         prompt.append({"role": "user", "content": previous_summary["content"]})
 
-    # The section of the conversation to summarize
-    conversation_text = ""
-    for m in to_summarize:
-        role = m["role"].capitalize()
-        conversation_text += f"{role}: {m['content'].strip()}\n\n"
+    # The section of the conversation to summarize, newest messages first in line for SLAVE_MODEL's budget
+    remaining = token_budget(SLAVE_MODEL) - sum(count_tokens(p["content"]) for p in prompt) - 500
+    lines = []
+    for m in reversed(to_summarize):
+        line = f"{m['role'].capitalize()}: {m['content'].strip()}\n\n"
+        remaining -= count_tokens(line)
+        if remaining < 0:
+            break
+        lines.append(line)
+    conversation_text = "".join(reversed(lines))
     
     # Add onto prompt
     if previous_summary:
@@ -218,8 +241,148 @@ def summarize_messages(client: OpenAI):
     # Replace old messages with a summary
     summary_msg = {"role": "system", "content": f"[SUMMARY OF PREVIOUS CONTEXT]: {summary}"}
 
-    # uprint(f"[CONTEXT WINDOW]: {[state.messages[0], summary_msg] + recent}" )
-    return [state.messages[0], summary_msg] + recent
+    # uprint(f"[CONTEXT WINDOW]: {[messages[0], summary_msg] + recent}" )
+    return MessageWindow([messages[0], summary_msg] + recent)
+
+# Starts summarizing a snapshot of the window in the background once it is over MASTER_MODEL's budget.
+# Called after the reply has gone out, so the SLAVE_MODEL round trip never delays a turn.
+def schedule_summary():
+    if state.current_chat_id in pending_summaries or not state.messages.over_budget(MASTER_MODEL):
+        return
+
+    snapshot = list(state.messages)
+    future = summary_executor.submit(summarize_messages, snapshot)
+    pending_summaries[state.current_chat_id] = (state.messages, snapshot, future)
+
+# Swaps a finished summary in at the start of a turn. Messages appended since the snapshot was
+# taken are carried over. Summaries are kept per chat, so one started before switching away is
+# still applied when the user comes back. If the window was replaced in the meantime (chat reloaded,
+# another summary) the summary is stale and dropped.
+def apply_pending_summary():
+    chat_id = state.current_chat_id
+    if chat_id not in pending_summaries:
+        return
+
+    source, snapshot, future = pending_summaries[chat_id]
+    if not future.done():
+        return
+    del pending_summaries[chat_id]
+
+    unchanged = (
+        state.messages is source
+        and len(state.messages) >= len(snapshot)
+        and state.messages[len(snapshot) - 1] is snapshot[-1]
+    )
+    if not unchanged:
+        return
+
+    try:
+        summarized = future.result()
+    except Exception as e:
+        uprint(f"[SUMMARY] failed: {e}", OutGoingDataType.LOG)
+        return
+
+    if summarized is snapshot:
+        return
+
+    summarized.extend(state.messages[len(snapshot):])
+    state.messages = summarized
+    sessions.put(chat_id, summarized)
+
+# Loads a chat's context window from the DB. Chats without a saved window start from their full history.
+def hydrate_session(chat_id: int) -> MessageWindow:
+    window = load_chat_window(chat_id)
+    if not window:
+        window = MessageWindow(get_chat_messages(chat_id))
+    return window
+
+# Makes chat_id the current chat. Recently used chats are kept hydrated in the session cache,
+# so switching back to one is a pointer swap, its summary and token count included.
+def switch_session(chat_id: int):
+    if state.current_chat_id is not None:
+        sessions.put(state.current_chat_id, state.messages)
+
+    state.current_chat_id = chat_id
+    messages = sessions.get(chat_id)
+    if messages is None:
+        messages = hydrate_session(chat_id)
+    state.messages = messages
+    sessions.put(chat_id, messages)
+
+    if not state.messages:
+        system_msg = {"role": "system", "content": system_prompt}
+        state.messages.append(system_msg)
+        msg_id = insert_message(chat_id, "system", system_prompt)
+        save_chat_window(msg_id)
+
+
+# Asks MASTER_MODEL for the next assistant message.
+# When streaming, text is forwarded to the frontend as it arrives (MESSAGE_DELTA) and the
+# full text is sent once at the end (MESSAGE_DONE). Tool call fragments are stitched back
+# together by index so the result looks exactly like a non-streamed ChatCompletionMessage.
+def get_completion(messages, stream: bool = STREAM_RESPONSES):
+    if not stream:
+        response = state.client.chat.completions.create(
+            model=MASTER_MODEL,
+            messages=messages,
+            tools=tool_definitions,
+            tool_choice="auto"
+        )
+        msg = response.choices[0].message
+        uprint(msg.content)
+        return msg
+
+    response = state.client.chat.completions.create(
+        model=MASTER_MODEL,
+        messages=messages,
+        tools=tool_definitions,
+        tool_choice="auto",
+        stream=True
+    )
+
+    content_parts = []
+    tool_calls = {} # index -> {"id", "name", "arguments"}
+
+    for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+
+        if delta.content:
+            content_parts.append(delta.content)
+            uprint(delta.content, OutGoingDataType.MESSAGE_DELTA)
+
+        for call in delta.tool_calls or []:
+            entry = tool_calls.setdefault(call.index, {"id": None, "name": "", "arguments": ""})
+            if call.id:
+                entry["id"] = call.id
+            if call.function:
+                if call.function.name:
+                    entry["name"] += call.function.name
+                if call.function.arguments:
+                    entry["arguments"] += call.function.arguments
+
+    content = "".join(content_parts) if content_parts else None
+    uprint(content, OutGoingDataType.MESSAGE_DONE)
+
+    return ChatCompletionMessage(
+        role="assistant",
+        content=content,
+        tool_calls=[
+            ChatCompletionMessageToolCall(
+                id=entry["id"],
+                type="function",
+                function=Function(name=entry["name"], arguments=entry["arguments"] or "{}")
+            )
+            for _, entry in sorted(tool_calls.items())
+        ] or None
+    )
+
+def run_tool(fn_name, args):
+    result = tool_functions.get(fn_name, lambda **_: f"Tool {fn_name} not found.")(**args)
+    if not isinstance(result, str):
+        result = json.dumps(result, indent=2)
+    return result
 
 def handle_tool_calls(msg, chat_id):
     times = 0
@@ -236,29 +399,45 @@ def handle_tool_calls(msg, chat_id):
                     "content": limit_msg
                 }
                 state.messages.append(tool_response)
-                insert_message(chat_id, "tool", limit_msg)
+                msg_id = insert_message(chat_id, "tool", limit_msg)
                 uprint(limit_msg, OutGoingDataType.TOOL_RETURN)
-                save_chat_window()
+                save_chat_window(msg_id)
 
             assistant_msg = {
                 "role": "assistant",
                 "content": "I've reached the maximum allowed number of tool calls. Requesting permission to continue."
             }
             state.messages.append(assistant_msg)
-            insert_message(chat_id, "assistant", assistant_msg["content"])
+            msg_id = insert_message(chat_id, "assistant", assistant_msg["content"])
             uprint(assistant_msg["content"])
-            save_chat_window()
+            save_chat_window(msg_id)
 
             return
 
+        calls = []
         for call in msg.tool_calls:
             fn_name = call.function.name
             args = json.loads(call.function.arguments)
             uprint(f"{fn_name}({', '.join(repr(v) for v in args.values())})", OutGoingDataType.TOOL_CALL)
-
-            result = tool_functions.get(fn_name, lambda **_: f"Tool {fn_name} not found.")(**args)
-            if not isinstance(result, str):
-                result = json.dumps(result, indent=2)
+            calls.append((call, fn_name, args))
+
+        # Calls run in the order the model asked for them. Consecutive parallel safe calls run together
+        # in the pool, a call that isn't parallel safe waits for them and runs alone before the next.
+        results = {}
+        pending = {}
+        for call, fn_name, args in calls:
+            if tool_parallel_safe.get(fn_name, True):
+                pending[call.id] = tool_executor.submit(run_tool, fn_name, args)
+                continue
+
+            results.update({call_id: future.result() for call_id, future in pending.items()})
+            pending.clear()
+            results[call.id] = run_tool(fn_name, args)
+        results.update({call_id: future.result() for call_id, future in pending.items()})
+
+        # Results are appended in the order the model asked for them
+        for call, fn_name, args in calls:
+            result = results[call.id]
 
             tool_msg = {"role": "tool", "tool_call_id": call.id, "content": result}
             
@@ -268,18 +447,11 @@ def handle_tool_calls(msg, chat_id):
             save_chat_window()
 
         # Follow up after tool execution
-        response = state.client.chat.completions.create(
-            model=MASTER_MODEL,
-            messages=state.messages,
-            tools=tool_definitions,
-            tool_choice="auto"
-        )
-        msg = response.choices[0].message
+        msg = get_completion(state.messages)
         
         state.messages.append(msg)
-        insert_message(chat_id, "assistant", msg.content)
-        uprint(msg.content)
-        save_chat_window()
+        msg_id = insert_message(chat_id, "assistant", msg.content)
+        save_chat_window(msg_id)
 
         times += 1
 
@@ -311,18 +483,9 @@ def handle_types(type, payload, meta):
         case "switch-chat":
             # If payload is null, create a new chat and return the new state of chats
             if payload is None:
-                state.current_chat_id = create_chat("New Chat")
-                state.messages = get_chat_messages(state.current_chat_id)
-                system_msg = {"role": "system", "content": system_prompt}
-                state.messages.append(system_msg)
-                insert_message(state.current_chat_id, "system", system_prompt)
-
-                chats = get_chats()
-                for chat in chats:
-                    chat["active"] = (chat["id"] == state.current_chat_id)
-                
-                # Return new state of chats
-                uprint(chats, OutGoingDataType.RETURN_ALL_CHATS)
+                switch_session(create_chat("New Chat"))
+
+                # The new chat itself reached the frontend as a chat-touched event
                 uprint(state.current_chat_id, OutGoingDataType.RETURN_CURRENT_CHAT_ID)
                 # Empty thread (except for system msg), but forces an update on the frontend
                 mes = get_chat_messages(state.current_chat_id, 10)
@@ -331,14 +494,8 @@ def handle_types(type, payload, meta):
             # Else, switch to an existing chat and return all messages from that chat
             else:
                 try:
-                    new_id = int(payload)
-                    state.current_chat_id = new_id
-                    state.messages = get_chat_messages(state.current_chat_id)
-                    if not state.messages:
-                        system_msg = {"role": "system", "content": system_prompt}
-                        state.messages.append(system_msg)
-                        insert_message(state.current_chat_id, "system", system_prompt)
-                    
+                    switch_session(int(payload))
+
                     uprint(state.current_chat_id, OutGoingDataType.RETURN_CURRENT_CHAT_ID)
 
                     mes = get_chat_messages(state.current_chat_id, 10)
@@ -390,25 +547,27 @@ def handle_types(type, payload, meta):
             
         case "rename-chat":
             rename_chat(chat_id=meta, new_name=payload)
-            chats = get_chats()
-            for chat in chats:
-                chat["active"] = (chat["id"] == state.current_chat_id)
-            uprint(chats, OutGoingDataType.RETURN_ALL_CHATS)
         
         case "delete-chat":
-            delete_chat(payload)
+            deleted_id = int(payload)
+            delete_chat(deleted_id)
+            sessions.pop(deleted_id)
+            pending_summaries.pop(deleted_id, None)
 
-            state.current_chat_id = get_latest_chat_id()
+            # Don't put the deleted chat back into the cache on the way out
+            if state.current_chat_id == deleted_id:
+                state.current_chat_id = None
+            switch_session(get_latest_chat_id())
 
-            chats = get_chats()
-            for chat in chats:
-                chat["active"] = (chat["id"] == state.current_chat_id)
-            
-            uprint(chats, OutGoingDataType.RETURN_ALL_CHATS)
+            uprint(state.current_chat_id, OutGoingDataType.RETURN_CURRENT_CHAT_ID)
 
 def chat():
     while True:
-        data = json.loads(input())
+        try:
+            line = input()
+        except EOFError:
+            return # The launcher closed our stdin, exit normally so atexit flushes run
+        data = json.loads(line)
         data = data[0]
         type = data['type']
         payload = data['payload']
@@ -420,71 +579,71 @@ def chat():
         if type != "user-message":
             continue
 
+        # The user's message is committed right away, so it survives the backend being killed mid-turn
         state.messages.append({"role": "user", "content": payload})
-        insert_message(state.current_chat_id, "user", payload)
-
-        # If needed, check for if we need to summarize here
-        state.messages = summarize_messages(state.client)
+        msg_id = insert_message(state.current_chat_id, "user", payload)
+        save_chat_window(msg_id)
+
+        # Everything else the turn writes to the DB is committed in one transaction.
+        # Tool reloads wait for the turn to end, so its tools don't change halfway through
+        with tools_lock, write_batch():
+            # Swap in the summary built in the background after the last turn, if it is ready
+            apply_pending_summary()
         
-        # Get emphereal RAG messages
-        rag_results = query_embeddings(state.current_chat_id, payload, TOP_K)
-        filtered_rag_results = [r for r in rag_results if r['distance'] < DISTANCE_THRESHOLD]
-
-        uprint(f"[RETREIVED] {filtered_rag_results}", OutGoingDataType.LOG)
-        rag_messages = [
-            {
-                "role": "system",
-                "content": f"[RAG retrieved message from {r['role']}]: {r['document']}"
-            }
-            for r in filtered_rag_results
-        ]
+            # Get emphereal RAG messages
+            filtered_rag_results = query_messages(state.current_chat_id, payload, TOP_K)
+
+            uprint(f"[RETREIVED] {filtered_rag_results}", OutGoingDataType.LOG)
+            rag_messages = [
+                {
+                    "role": "system",
+                    "content": f"[RAG retrieved message from {r['role']}]: {r['document']}"
+                }
+                for r in filtered_rag_results
+            ]
 
-        save_chat_window()
+            save_chat_window()
 
-        augmented_messages = rag_messages + state.messages
+            augmented_messages = rag_messages + state.messages
 
-        response = state.client.chat.completions.create(
-            model=MASTER_MODEL,
-            messages=augmented_messages,
-            tools=tool_definitions,
-            tool_choice="auto"
-        )
+            msg = get_completion(augmented_messages)
 
-        msg = response.choices[0].message
+            state.messages.append(msg)
+            msg_id = insert_message(state.current_chat_id, msg.role, msg.content)
+            save_chat_window(msg_id)
 
-        state.messages.append(msg)
-        insert_message(state.current_chat_id, msg.role, msg.content)
-        save_chat_window()
+            if msg.tool_calls:
+                handle_tool_calls(msg, state.current_chat_id)
 
-        if msg.tool_calls:
-            handle_tool_calls(msg, state.current_chat_id)
-        else:
-            uprint(msg.content)
+            # Persist current message thread to DB
+            save_chat_window()
 
-        # Persist current message thread to DB
-        save_chat_window()
+        # The reply is out, summarize in the background if the window got too long
+        schedule_summary()
 
 if __name__ == "__main__":
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
+    # SIGTERM would end the process without running atexit, which flushes queued embeddings and
+    # closes the DB. Exiting through SystemExit runs them.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     load_tools()
-    threading.Thread(target=lambda: start_file_watcher(load_tools), daemon=True).start()
+    threading.Thread(target=start_file_watcher, daemon=True).start()
 
     # Check if we actually have a DB lol
     init_db()
 
+    # Hydrate the most recently modified chats so the first switches are already warm,
+    # oldest first so the most recent ones end up at the top of the cache
+    for recent in reversed(get_chats()[:SESSION_CACHE_PREFILL]):
+        sessions.put(recent["id"], hydrate_session(recent["id"]))
+
     # Initialize the id of our most recently modified chat
     # If there are no chats, this creates a default chat and returns its ID
-    state.current_chat_id = get_latest_chat_id()
-    # Get the messages from that chat, if there are no messages, we need to append the initial system message 
-    state.messages = load_chat_window(state.current_chat_id)
-
-    if not state.messages:
-        system_msg = {"role": "system", "content": system_prompt}
-        state.messages.append(system_msg)
-        insert_message(state.current_chat_id, "system", system_prompt)
-        save_chat_window()
+    # If it has no messages yet, switch_session appends the initial system message
+    switch_session(get_latest_chat_id())
 
 
     # Make sure .env file exists
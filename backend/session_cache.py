@@ -0,0 +1,38 @@
+from collections import OrderedDict
+
+from config import SESSION_CACHE_MAX_CHATS, SESSION_CACHE_MAX_TOKENS
+
+# LRU of hydrated chat sessions: chat id -> the chat's context window (a MessageWindow, which also
+# carries its token count). Switching to a cached chat just swaps state.messages, its summary and
+# pending background summary stay as they were. The cache is capped by number of chats and by the
+# total tokens of the windows it holds; on_evict is called for every chat that falls out.
+class SessionCache:
+    def __init__(self, max_chats: int = SESSION_CACHE_MAX_CHATS, max_tokens: int = SESSION_CACHE_MAX_TOKENS, on_evict=None):
+        self.sessions = OrderedDict() # least recently used first
+        self.max_chats = max_chats
+        self.max_tokens = max_tokens
+        self.on_evict = on_evict
+
+    def get(self, chat_id: int):
+        messages = self.sessions.get(chat_id)
+        if messages is not None:
+            self.sessions.move_to_end(chat_id)
+        return messages
+
+    def put(self, chat_id: int, messages):
+        self.sessions[chat_id] = messages
+        self.sessions.move_to_end(chat_id)
+        self.evict()
+
+    def pop(self, chat_id: int):
+        return self.sessions.pop(chat_id, None)
+
+    def evict(self):
+        # The most recently used session always stays, even if it's over the cap on its own
+        while len(self.sessions) > 1 and (
+            len(self.sessions) > self.max_chats
+            or sum(m.tokens for m in self.sessions.values()) > self.max_tokens
+        ):
+            chat_id, _ = self.sessions.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(chat_id)
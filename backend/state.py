@@ -1,5 +1,10 @@
+import threading
+from context_budget import MessageWindow
+
 tool_definitions=[]
 tool_functions={}
+tool_parallel_safe={}
+tools_lock = threading.Lock() # held by chat() during a turn, the watcher swaps the tool registry under it
 client = None
 current_chat_id = None
-messages = []
\ No newline at end of file
+messages = MessageWindow()
\ No newline at end of file
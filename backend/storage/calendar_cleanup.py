@@ -0,0 +1,27 @@
+import threading
+import time
+
+from config import CALENDAR_CLEANUP_INTERVAL
+from storage.db import write_async
+
+# Removes past events from calendar_events (tools/calendar.py) on a timer. It is started by init_db
+# once the DB is open and migrated, not by the calendar tools: tools/calendar.py is only imported
+# when one of its tools is first called (see watcher.py), which on a warm start may be never.
+
+DELETE_PAST_EVENTS = "DELETE FROM calendar_events WHERE start_ts <= ?"
+
+def clean_calendar():
+    write_async(lambda conn: conn.execute(DELETE_PAST_EVENTS, (int(time.time()), )))
+
+def schedule_cleanup():
+    timer = threading.Timer(CALENDAR_CLEANUP_INTERVAL, run_cleanup)
+    timer.daemon = True
+    timer.start()
+
+def run_cleanup():
+    clean_calendar()
+    schedule_cleanup()
+
+# Events that passed while the backend wasn't running are removed right away
+def start_calendar_cleanup():
+    run_cleanup()
@@ -1,6 +1,10 @@
-import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from pathlib import Path
+import re
+import sqlite3
 import threading
+import time
 from typing import List, Dict
 import json
 
@@ -9,23 +13,87 @@ import state
 import chromadb
 from chromadb.config import Settings
 from uprint import OutGoingDataType, uprint
-
-DB_PATH = Path(__file__).parent / "chat_memory.db"
+from storage.calendar_cleanup import start_calendar_cleanup
+from storage.db import open_db, read, write, write_async
+from storage.embeddings import embed, queue_embedding, start_embedding_worker
+from storage.embedders import OpenAIEmbedder, get_embedder
+from storage.migrations import migrate
+from context_budget import MessageWindow
+from config import RAG_FTS_CANDIDATES, RAG_FTS_MIN_COVERAGE, RAG_FTS_MIN_TERMS, RAG_OVERFETCH, RAG_VECTOR_COOLDOWN, RAG_VECTOR_TIMEOUT, RRF_K
+
+INSERT_CHAT = "INSERT INTO chats (name) VALUES (?)"
+INSERT_MESSAGE = "INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)"
+TOUCH_CHAT = "UPDATE chats SET last_modified = CURRENT_TIMESTAMP where id = ?"
+RENAME_CHAT = "UPDATE chats SET name = ? WHERE id = ?"
+DELETE_CHAT = "DELETE FROM chats WHERE id = ?"
+SELECT_CHATS = "SELECT id, name, created_at FROM chats ORDER BY last_modified DESC"
+SELECT_CHAT = "SELECT id, name, created_at FROM chats WHERE id = ?"
+SELECT_LATEST_CHAT = "SELECT id FROM chats ORDER BY created_at DESC LIMIT 1"
+SELECT_MESSAGES_PAGE = "SELECT id, role, content FROM messages WHERE chat_id = ? and id < ? ORDER BY id DESC LIMIT ?"
+SELECT_LEGACY_WINDOW = "SELECT window FROM chat_windows WHERE chat_id = ?"
+SELECT_WINDOW_ENTRIES = """
+    SELECT e.message_id, e.data, m.role, m.content
+    FROM chat_window_entries e LEFT JOIN messages m ON m.id = e.message_id
+    WHERE e.chat_id = ? ORDER BY e.position
+"""
+INSERT_WINDOW_ENTRY = "INSERT INTO chat_window_entries (chat_id, position, message_id, data) VALUES (?, ?, ?, ?)"
+# Same messages that get embedded: user and assistant text, no tool call summaries
+SELECT_FTS_MATCHES = """
+    SELECT m.id, m.chat_id, m.role, m.content
+    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+    WHERE messages_fts MATCH ? AND m.chat_id != ?
+        AND m.role IN ('user', 'assistant') AND m.content NOT LIKE 'tool-call:%'
+    ORDER BY bm25(messages_fts)
+    LIMIT ?
+"""
+
+# Words too common to say anything about relevance in a lexical match
+FTS_STOPWORDS = {
+    "the", "and", "for", "are", "but", "not", "you", "all", "any", "can", "had", "her", "was", "one",
+    "our", "out", "has", "his", "how", "its", "may", "who", "did", "get", "got", "let", "she", "too",
+    "use", "that", "with", "have", "this", "will", "your", "from", "they", "what", "when", "make",
+    "like", "just", "know", "take", "into", "than", "then", "them", "some", "could", "would", "there",
+    "their", "about", "which", "these", "other", "please", "want", "need", "does", "can't", "don't",
+    "why", "where", "here", "also", "very", "much", "more",
+}
 
 chroma_client = None
 chroma_collection = None
+fts_enabled = False
+
+# Runs the vector half of query_messages so it can be abandoned when it's too slow
+retrieval_executor = ThreadPoolExecutor(max_workers=2)
+vector_retry_at = 0 # monotonic time before which vector search is skipped
+
+# In-memory copy of the chat list, most recently modified first (id -> {"id", "name", "created_at"}).
+# Changes are pushed to the frontend as CHAT_TOUCHED / CHAT_RENAMED / CHAT_DELETED deltas,
+# the full list is only sent when the frontend asks for it with get-all-chats.
+chat_index = OrderedDict()
+chat_index_lock = threading.Lock()
+
+# The context window is stored as ordered rows in chat_window_entries. An entry either points at
+# the messages row holding its content (message_id, with any extra fields like tool_calls in data)
+# or keeps the whole serialized message in data. window_tracking remembers, per chat, which window
+# list was persisted and the (message, message_id) of each entry, so save_chat_window only has to
+# append what is new. When a chat's window is replaced by a different list (summary) it is rewritten.
+window_tracking = {} # chat id -> (window list, [(message object, message_id)])
 
 def init_db():
-    global chroma_client, chroma_collection
+    global chroma_client, chroma_collection, fts_enabled
 
     chroma_client = chromadb.PersistentClient(
         path=str(Path(__file__).parent / "chroma_index"),
         settings=Settings(allow_reset=True)
     )
 
-    chroma_collection = chroma_client.get_or_create_collection(name="buddy_messages")
-    
-    with sqlite3.connect(DB_PATH) as conn:
+    # Each embedder gets its own collection, vectors of different models can't be compared
+    embedder = get_embedder()
+    collection_name = "buddy_messages" if isinstance(embedder, OpenAIEmbedder) else f"buddy_messages_{embedder.name}"
+    chroma_collection = chroma_client.get_or_create_collection(name=collection_name)
+
+    open_db()
+
+    def create_tables(conn):
         cursor = conn.cursor()
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS chats (
@@ -46,6 +114,26 @@ def init_db():
         )
         """)
         cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_window_entries (
+            chat_id INTEGER,
+            position INTEGER,
+            message_id INTEGER,
+            data TEXT,
+            PRIMARY KEY (chat_id, position),
+            FOREIGN KEY (chat_id) REFERENCES chats(id),
+            FOREIGN KEY (message_id) REFERENCES messages(id)
+        )
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            key TEXT PRIMARY KEY,
+            embedding BLOB,
+            last_used REAL
+        )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used ON embedding_cache(last_used)")
+        # Old format: the whole window as one JSON blob, only read for chats saved before chat_window_entries
+        cursor.execute("""
         CREATE TABLE IF NOT EXISTS chat_windows (
             chat_id INTEGER PRIMARY KEY,
             window TEXT,
@@ -54,186 +142,391 @@ def init_db():
         )
         """)
 
+        # Full text index over messages, kept in sync by triggers
+        if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+            return True
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', content_rowid='id')")
+        except sqlite3.OperationalError:
+            return False # SQLite built without FTS5, retrieval falls back to vectors only
+        cursor.execute("""
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+        """)
+        cursor.execute("""
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+        """)
+        cursor.execute("""
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+        """)
+        # Index the messages stored before the table existed
+        cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        return True
+
+    fts_enabled = write(create_tables)
+    # create_tables is schema version 0, later changes (indexes, cascades...) are migrations
+    migrate()
+
+    # Started after open_db so its atexit flush runs before close_db (atexit runs in reverse order),
+    # the flush still reads and writes the embedding cache
+    start_embedding_worker(chroma_collection)
+    start_calendar_cleanup()
+
+    rows = read(lambda conn: conn.execute(SELECT_CHATS).fetchall())
+    with chat_index_lock:
+        chat_index.clear()
+        for row in rows:
+            chat_index[row[0]] = {"id": row[0], "name": row[1], "created_at": row[2]}
+
 def store_embeddings(chat_id: int, role: str, content: str, msg_id: int, tags: list[str] = None):
     global chroma_collection
 
     if chroma_collection is None:
         raise Exception("Chroma collection not initialized!")
-    
-    def task(chat_id, role, content, msg_id, tags):
-        embedding_response = state.client.embeddings.create(
-            model="text-embedding-3-small",
-            input=content
-        )
-        
-        embedding = embedding_response.data[0].embedding
 
-        metadata = {
-            "chat_id": str(chat_id),
-            "role": role,
-            "message_id": str(msg_id)
-        }
+    metadata = {
+        "chat_id": str(chat_id),
+        "role": role,
+        "message_id": str(msg_id)
+    }
 
-        if tags is not None:
-            metadata["tags"] = ",".join(tags)
-        
-        chroma_collection.add(
-            embeddings=[embedding], 
-            documents=[content], 
-            ids=[str(msg_id)], 
-            metadatas=[metadata]
-        )
-    
-    threading.Thread(
-        target=task, 
-        args=(chat_id, role, content, msg_id, tags)
-    ).start()
+    if tags is not None:
+        metadata["tags"] = ",".join(tags)
 
-def query_embeddings(chat_id: int, content: str, topK: int):
+    # Embedded and added to chroma in batches by the embedding worker
+    queue_embedding({"id": str(msg_id), "document": content, "metadata": metadata})
+
+# Returns up to topK messages from other chats closer than max_distance (by default the cutoff of
+# the embedder in use), nearest first
+def query_embeddings(chat_id: int, content: str, topK: int, max_distance: float = None):
     global chroma_collection
 
     if chroma_collection is None:
         raise Exception("Chroma collection not initialized!")
+    if max_distance is None:
+        max_distance = get_embedder().max_distance
     
-    embedding_response = state.client.embeddings.create(
-        model="text-embedding-3-small",
-        input=content
+    query_embedding = embed([content])[0]
+
+    # The current chat is excluded by chroma itself, so every hit it returns is usable
+    results = chroma_collection.query(
+        query_embeddings=[query_embedding],
+        n_results=topK + RAG_OVERFETCH,
+        where={"chat_id": {"$ne": str(chat_id)}},
+        include=["metadatas", "documents", "distances"]
     )
-    
-    query_embedding = embedding_response.data[0].embedding
-
-    results = chroma_collection.query(query_embeddings=[query_embedding], n_results=topK, include=["metadatas", "documents", "distances"])
 
     filtered_results = []
+    seen = set()
 
     for doc, meta, dist in zip(results['documents'][0], results['metadatas'][0], results['distances'][0]):
-        if meta['chat_id'] != str(chat_id):
-            filtered_results.append({
-                "document": doc,
-                "chat_id": meta['chat_id'],
-                "message_id": meta['message_id'],
-                "role": meta['role'],
-                "distance": dist
-            })
+        # Hits come back nearest first, nothing after this one is close enough
+        if dist >= max_distance:
+            break
+        # The same text said in several chats only needs to be retrieved once
+        if doc in seen:
+            continue
+        seen.add(doc)
+
+        filtered_results.append({
+            "document": doc,
+            "chat_id": meta['chat_id'],
+            "message_id": meta['message_id'],
+            "role": meta['role'],
+            "distance": dist
+        })
+        if len(filtered_results) == topK:
+            break
 
     return filtered_results
 
+def fts_terms(content: str) -> list[str]:
+    terms = []
+    for term in re.findall(r"[\w][\w.:/\-']*", content.lower()):
+        term = term.strip(".:/-'")
+        if len(term) < 3 and not any(c.isdigit() for c in term):
+            continue
+        if term in FTS_STOPWORDS or term in terms:
+            continue
+        terms.append(term)
+    return terms[:32]
+
+def fts_query(terms: list[str]) -> str:
+    # Each term is quoted so identifiers like file names, error codes and spotify uris are matched
+    # as phrases of their parts instead of being parsed as FTS syntax
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def is_identifier(term: str) -> bool:
+    return any(c.isdigit() or c in "._:/-" for c in term)
+
+# The query ORs every term, so a single common word ("file", "code") matches messages of any chat.
+# The embedder's max_distance keeps those out of the vector hits, here a hit has to contain an identifier of
+# the query, or enough of its plain words.
+def is_relevant(terms: list[str], doc: str) -> bool:
+    text = doc.lower()
+    words = set(re.findall(r"[\w']+", text))
+    plain = [term for term in terms if not is_identifier(term)]
+    if any(term in text for term in terms if is_identifier(term)):
+        return True
+
+    matched = sum(term in words for term in plain)
+    return matched >= max(RAG_FTS_MIN_TERMS, RAG_FTS_MIN_COVERAGE * len(plain))
+
+# BM25 ranked messages from other chats sharing words with content
+def query_lexical(chat_id: int, content: str, topK: int):
+    if not fts_enabled:
+        return []
+
+    terms = fts_terms(content)
+    if not terms:
+        return []
+
+    rows = read(lambda conn: conn.execute(SELECT_FTS_MATCHES, (fts_query(terms), chat_id, max(topK, RAG_FTS_CANDIDATES))).fetchall())
+    rows = [row for row in rows if is_relevant(terms, row[3])][:topK]
+    return [
+        {
+            "document": doc,
+            "chat_id": str(c_id),
+            "message_id": str(m_id),
+            "role": role,
+            "distance": None
+        }
+        for m_id, c_id, role, doc in rows
+    ]
+
+# Hybrid retrieval: vector hits and BM25 hits merged by reciprocal rank fusion.
+# The vector search needs an embedding first, if it fails or takes longer than RAG_VECTOR_TIMEOUT
+# the answer comes from FTS alone, and vector search is skipped for RAG_VECTOR_COOLDOWN seconds.
+def query_messages(chat_id: int, content: str, topK: int):
+    global vector_retry_at
+
+    vector_future = None
+    if time.monotonic() >= vector_retry_at:
+        vector_future = retrieval_executor.submit(query_embeddings, chat_id, content, topK)
+
+    lexical = query_lexical(chat_id, content, topK)
+
+    vector = []
+    if vector_future is not None:
+        try:
+            vector = vector_future.result(timeout=RAG_VECTOR_TIMEOUT)
+        except TimeoutError:
+            uprint("[RAG] vector search timed out, using FTS results only", OutGoingDataType.LOG)
+            vector_retry_at = time.monotonic() + RAG_VECTOR_COOLDOWN
+        except Exception as e:
+            uprint(f"[RAG] vector search failed, using FTS results only: {e}", OutGoingDataType.LOG)
+            vector_retry_at = time.monotonic() + RAG_VECTOR_COOLDOWN
+
+    scores = {}
+    results = {}
+    for ranked in (vector, lexical):
+        for rank, r in enumerate(ranked):
+            scores[r["message_id"]] = scores.get(r["message_id"], 0) + 1 / (RRF_K + rank + 1)
+            # Keep the vector version of a hit, it carries the distance
+            results.setdefault(r["message_id"], r)
+
+    merged = []
+    seen = set()
+    for message_id in sorted(scores, key=scores.get, reverse=True):
+        r = results[message_id]
+        if r["document"] in seen:
+            continue
+        seen.add(r["document"])
+        merged.append(r)
+
+    return merged[:topK]
+
+def touch_chat_index(chat: dict):
+    with chat_index_lock:
+        if next(iter(chat_index), None) == chat["id"]:
+            return # Already at the top, nothing changes on the frontend
+        chat_index[chat["id"]] = chat
+        chat_index.move_to_end(chat["id"], last=False)
+    uprint(chat, OutGoingDataType.CHAT_TOUCHED)
+
 def create_chat(name: str = None) -> int:
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO chats (name) VALUES (?)", (name, ))
-        return cursor.lastrowid
+    def task(conn):
+        chat_id = conn.execute(INSERT_CHAT, (name, )).lastrowid
+        return conn.execute(SELECT_CHAT, (chat_id, )).fetchone()
+
+    row = write(task)
+    touch_chat_index({"id": row[0], "name": row[1], "created_at": row[2]})
+    return row[0]
 
 def delete_chat(chat_id: int):
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
-        cursor.execute("DELETE FROM chat_windows WHERE chat_id = ?", (chat_id,))
-        cursor.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+    chat_id = int(chat_id)
+
+    def task(conn):
+        # Messages, window entries and the legacy window go with it (ON DELETE CASCADE)
+        conn.execute(DELETE_CHAT, (chat_id,))
+
+    write_async(task)
+    forget_chat_window(chat_id)
+
+    with chat_index_lock:
+        chat_index.pop(chat_id, None)
+    uprint({"id": chat_id}, OutGoingDataType.CHAT_DELETED)
 
 def get_chats():
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, created_at FROM chats ORDER BY last_modified DESC")
-        rows = cursor.fetchall()
-        return [{"id": row[0], "name": row[1], "created_at": row[2]} for row in rows]
+    with chat_index_lock:
+        return [dict(chat) for chat in chat_index.values()]
 
 def get_latest_chat_id():
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM chats ORDER BY created_at DESC LIMIT 1")
-        row = cursor.fetchone()
-        if row:
-            return row[0]
-        return create_chat("New Chat")
+    row = read(lambda conn: conn.execute(SELECT_LATEST_CHAT).fetchone())
+    if row:
+        return row[0]
+    return create_chat("New Chat")
 
+# Returns the id of the new messages row, or None if there was nothing to store
 def insert_message(chat_id: int, role: str, content: str):
+    if content == None:
+        return
     
-    with sqlite3.connect(DB_PATH) as conn:
-        if content == None:
-            return
-        
-        if not isinstance(content, str):
-            content = json.dumps(content, ensure_ascii=False)
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False)
 
+    def task(conn):
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)", (chat_id, role, content))
-
+        cursor.execute(INSERT_MESSAGE, (chat_id, role, content))
         msg_id = cursor.lastrowid
+        cursor.execute(TOUCH_CHAT, (chat_id, ))
+        return msg_id
 
-        cursor.execute("UPDATE chats SET last_modified = CURRENT_TIMESTAMP where id = ?", (chat_id, ))
-
-        chats = get_chats()
-        for chat in chats:
-            chat["active"] = (chat["id"] == state.current_chat_id)
-        uprint(chats, OutGoingDataType.RETURN_ALL_CHATS)
+    msg_id = write(task)
 
+    with chat_index_lock:
+        chat = chat_index.get(chat_id)
+    if chat is not None:
+        touch_chat_index(chat)
 
-    if content != None and role != "system" and role != "tool" and not content.startswith("tool-call:"):
+    if role != "system" and role != "tool" and not content.startswith("tool-call:"):
 
         # TODO Add a simple filter for whether or not the message should be embedded
         store_embeddings(chat_id, role, content, msg_id)
 
+    return msg_id
+
 def get_chat_messages(chat_id: int, limit: int = 20, before_id: int = float('inf')) -> List[Dict]:
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, role, content FROM messages WHERE chat_id = ? and id < ? ORDER BY id DESC LIMIT ?", (chat_id, before_id, limit))
+    rows = read(lambda conn: conn.execute(SELECT_MESSAGES_PAGE, (chat_id, before_id, limit)).fetchall())
 
-        results = [{"id": id, "role": role, "content": content} for id, role, content in cursor.fetchall()]
-        return results[::-1]
+    results = [{"id": id, "role": role, "content": content} for id, role, content in rows]
+    return results[::-1]
     
-def save_chat_window():
+def serialize_msg(msg):
+    def to_dict(obj):
+        if isinstance(obj, dict):
+            return {k: to_dict(v) for k, v in obj.items()}
+        elif isinstance(obj, list):
+            return [to_dict(item) for item in obj]
+        elif hasattr(obj, "__dict__"):
+            return to_dict(vars(obj))
+        else:
+            return obj
+
+    if isinstance(msg, dict):
+        return to_dict(msg)
+
+    return {
+        "role": msg.role,
+        "content": msg.content,
+        "function_call": to_dict(getattr(msg, "function_call", None)),
+        "tool_calls": to_dict(getattr(msg, "tool_calls", None)),
+        "refusal": to_dict(getattr(msg, "refusal", None)),
+        "annotations": to_dict(getattr(msg, "annotations", [])),
+    }
+
+def window_entry(msg, msg_id):
+    serialized = serialize_msg(msg)
+    if msg_id is None:
+        return json.dumps(serialized, ensure_ascii=False)
+
+    # Role and content live in the messages row, only keep what isn't there
+    extra = {k: v for k, v in serialized.items() if k not in ("role", "content") and v not in (None, [])}
+    return json.dumps(extra, ensure_ascii=False) if extra else None
+
+# Persists new messages of state.messages.
+# msg_id is the messages row of the last new message, when its content was stored there as is.
+def save_chat_window(msg_id: int = None):
     chat_id = state.current_chat_id
     window = state.messages
 
-    def serialize_msg(msg):
-        def to_dict(obj):
-            if isinstance(obj, dict):
-                return {k: to_dict(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [to_dict(item) for item in obj]
-            elif hasattr(obj, "__dict__"):
-                return to_dict(vars(obj))
-            else:
-                return obj
-
-        if isinstance(msg, dict):
-            return to_dict(msg)
-
-        return {
-            "role": msg.role,
-            "content": msg.content,
-            "function_call": to_dict(getattr(msg, "function_call", None)),
-            "tool_calls": to_dict(getattr(msg, "tool_calls", None)),
-            "refusal": to_dict(getattr(msg, "refusal", None)),
-            "annotations": to_dict(getattr(msg, "annotations", [])),
-        }
+    window_list, window_refs = window_tracking.get(chat_id, (None, []))
+    rewrite = window_list is not window or len(window_refs) > len(window)
 
-    serializable_window = [serialize_msg(m) for m in window]
+    if rewrite:
+        # Messages kept from the previous window still point at their rows
+        known_ids = {id(m): m_id for m, m_id in window_refs}
+        refs = [(m, known_ids.get(id(m))) for m in window]
+        start = 0
+    else:
+        refs = [(m, None) for m in window[len(window_refs):]]
+        start = len(window_refs)
 
-    with sqlite3.connect(DB_PATH) as conn:
+    if not refs and not rewrite:
+        return
+
+    if msg_id is not None and refs:
+        refs[-1] = (refs[-1][0], msg_id)
+
+    rows = [(chat_id, start + i, m_id, window_entry(m, m_id)) for i, (m, m_id) in enumerate(refs)]
+
+    def task(conn):
         cursor = conn.cursor()
-        window_json = json.dumps(serializable_window, ensure_ascii=False)
-        cursor.execute("""
-            INSERT INTO chat_windows (chat_id, window)
-            VALUES (?, ?)
-            ON CONFLICT(chat_id) DO UPDATE SET
-                window = excluded.window,
-                updated_at = CURRENT_TIMESTAMP
-        """, (chat_id, window_json))
+        if rewrite:
+            cursor.execute("DELETE FROM chat_window_entries WHERE chat_id = ?", (chat_id,))
+            cursor.execute("DELETE FROM chat_windows WHERE chat_id = ?", (chat_id,))
+        cursor.executemany(INSERT_WINDOW_ENTRY, rows)
+
+    write_async(task)
+
+    if rewrite:
+        window_tracking[chat_id] = (window, refs)
+    else:
+        window_refs.extend(refs)
+
+# Stops tracking a chat's window, e.g. when its session leaves the session cache.
+# The next save of that chat rewrites its entries.
+def forget_chat_window(chat_id: int):
+    window_tracking.pop(chat_id, None)
 
 
 def load_chat_window(chat_id: int):
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT window FROM chat_windows WHERE chat_id = ?", (chat_id,))
-        row = cursor.fetchone()
+    rows = read(lambda conn: conn.execute(SELECT_WINDOW_ENTRIES, (chat_id,)).fetchall())
+
+    if not rows:
+        # Chats saved before chat_window_entries existed, the next save rewrites them as entries
+        row = read(lambda conn: conn.execute(SELECT_LEGACY_WINDOW, (chat_id,)).fetchone())
         if row:
-            return json.loads(row[0])
-        return []
+            return MessageWindow(json.loads(row[0]))
+        return MessageWindow()
+
+    window = MessageWindow()
+    refs = []
+    for msg_id, data, role, content in rows:
+        if msg_id is not None:
+            msg = {"role": role, "content": content}
+            if data:
+                msg.update(json.loads(data))
+        else:
+            msg = json.loads(data)
+        window.append(msg)
+        refs.append((msg, msg_id))
+
+    window_tracking[chat_id] = (window, refs)
+    return window
     
 
 def rename_chat(chat_id: int, new_name: str):
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE chats SET name = ? WHERE id = ?", (new_name, chat_id))
\ No newline at end of file
+    chat_id = int(chat_id)
+    write_async(lambda conn: conn.execute(RENAME_CHAT, (new_name, chat_id)))
+
+    with chat_index_lock:
+        if chat_id in chat_index:
+            chat_index[chat_id]["name"] = new_name
+    uprint({"id": chat_id, "name": new_name}, OutGoingDataType.CHAT_RENAMED)
\ No newline at end of file
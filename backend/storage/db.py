@@ -0,0 +1,189 @@
+import atexit
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from pathlib import Path
+
+from uprint import OutGoingDataType, uprint
+
+DB_PATH = Path(__file__).parent / "chat_memory.db"
+
+# Connection layer for chat_memory.db
+#
+# All writes go through one long-lived connection owned by a writer thread, so the main loop,
+# tool threads and embedding threads never fight over the database lock. Jobs that arrive back to
+# back share a transaction, and write_batch() holds the transaction open so that everything written
+# during one turn is committed once. Reads use a separate connection per thread (WAL lets them run
+# next to the writer), unless the caller still has writes in flight, in which case the read is
+# queued behind them on the writer connection so it always sees its own writes.
+#
+# Statements are plain SQL constants, sqlite3 keeps them prepared in each connection's statement cache.
+
+_BEGIN_BATCH = object()
+_END_BATCH = object()
+_STOP = object()
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA foreign_keys=ON") # Deleting a chat cascades to its messages and window
+    return conn
+
+class DBWriter(threading.Thread):
+    def __init__(self):
+        super().__init__(name="db-writer", daemon=True)
+        self.jobs = queue.Queue()
+        self.pending = 0 # submitted jobs whose futures are not resolved yet
+        self.pending_lock = threading.Lock()
+
+    def submit(self, fn) -> Future:
+        future = Future()
+        with self.pending_lock:
+            self.pending += 1
+        self.jobs.put((fn, future))
+        return future
+
+    def run(self):
+        conn = _connect()
+        depth = 0
+        waiting = [] # (future, result, error) to resolve once the transaction commits
+
+        while True:
+            job = self.jobs.get()
+
+            if job is _STOP:
+                break
+            elif job is _BEGIN_BATCH:
+                depth += 1
+            elif job is _END_BATCH:
+                depth -= 1
+            else:
+                fn, future = job
+                # Beginning can fail too (e.g. another process held the lock past busy_timeout), the
+                # job fails with it and the thread keeps serving the next ones
+                try:
+                    if not conn.in_transaction:
+                        conn.execute("BEGIN IMMEDIATE")
+                    conn.execute("SAVEPOINT job")
+                except Exception as e:
+                    waiting.append((future, None, e))
+                else:
+                    # A failing job only undoes its own statements, not the rest of the transaction
+                    try:
+                        waiting.append((future, fn(conn), None))
+                        conn.execute("RELEASE job")
+                    except Exception as e:
+                        self._rollback_job(conn)
+                        waiting.append((future, None, e))
+
+                # Inside a batch the caller can't wait for the commit (it hasn't closed the batch yet)
+                if depth > 0:
+                    self._resolve(waiting)
+
+            if depth == 0 and self.jobs.empty():
+                self._commit(conn, waiting)
+
+        self._commit(conn, waiting)
+        conn.close()
+
+    def _rollback_job(self, conn):
+        try:
+            conn.execute("ROLLBACK TO job")
+            conn.execute("RELEASE job")
+        except Exception:
+            # The savepoint is gone (the job ended the transaction itself), drop whatever is left
+            self._rollback(conn)
+
+    def _rollback(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+        except Exception as e:
+            uprint(f"[DB] rollback failed: {e}", OutGoingDataType.LOG)
+
+    def _commit(self, conn, waiting):
+        if conn.in_transaction:
+            try:
+                conn.execute("COMMIT")
+            except Exception as e:
+                # Jobs of a batch were resolved before the commit, this is the only trace of their loss
+                uprint(f"[DB] commit failed, the transaction was rolled back: {e}", OutGoingDataType.LOG)
+                self._rollback(conn)
+                waiting[:] = [(future, None, e) for future, _, _ in waiting]
+        self._resolve(waiting)
+
+    def _resolve(self, waiting):
+        for future, result, error in waiting:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        with self.pending_lock:
+            self.pending -= len(waiting)
+        waiting.clear()
+
+_writer = None
+_batches = 0
+_batches_lock = threading.Lock()
+_local = threading.local()
+
+def open_db():
+    global _writer
+    if _writer is not None:
+        return
+
+    _writer = DBWriter()
+    _writer.start()
+    atexit.register(close_db)
+
+def close_db():
+    global _writer
+    if _writer is None:
+        return
+
+    _writer.jobs.put(_STOP)
+    _writer.join()
+    _writer = None
+
+# Runs fn(conn) on the writer connection and waits for its result
+def write(fn):
+    return _writer.submit(fn).result()
+
+# Runs fn(conn) on the writer connection without waiting, errors are logged
+def write_async(fn) -> Future:
+    def log_error(future):
+        if future.exception() is not None:
+            uprint(f"[DB] write failed: {future.exception()}", OutGoingDataType.LOG)
+
+    future = _writer.submit(fn)
+    future.add_done_callback(log_error)
+    return future
+
+# Every write made inside the block is committed in a single transaction when the block exits
+@contextmanager
+def write_batch():
+    global _batches
+    with _batches_lock:
+        _batches += 1
+    _writer.jobs.put(_BEGIN_BATCH)
+    try:
+        yield
+    finally:
+        _writer.jobs.put(_END_BATCH)
+        # Keeps pending above zero until the batch commits, so reads keep seeing its writes
+        _writer.submit(lambda conn: None)
+        with _batches_lock:
+            _batches -= 1
+
+def read(fn):
+    if _batches > 0 or _writer.pending > 0:
+        return write(fn)
+
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    return fn(conn)
@@ -0,0 +1,101 @@
+import math
+import re
+import zlib
+
+import state
+from config import DISTANCE_THRESHOLD, EMBEDDER, EMBEDDING_MODEL, LOCAL_EMBEDDING_DIM, LOCAL_DISTANCE_THRESHOLD
+
+# Embedding backends, the one used for RAG is picked with EMBEDDER in config.py.
+#
+# name identifies the vector space: it is part of the embedding cache key and of the chroma
+# collection name, so switching backends never mixes vectors of different models.
+# cacheable tells the embedding cache whether a result is worth storing.
+# max_distance is the squared L2 distance (chroma's default space) under which a hit counts as
+# related, it depends on how the model spreads its vectors so every embedder has its own.
+
+class Embedder:
+    name = None
+    cacheable = True
+    max_distance = DISTANCE_THRESHOLD
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        raise NotImplementedError
+
+class OpenAIEmbedder(Embedder):
+    def __init__(self, model: str = EMBEDDING_MODEL):
+        self.name = model
+
+    def embed(self, texts):
+        response = state.client.embeddings.create(
+            model=self.name,
+            input=texts
+        )
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+# Local, offline embedder: words and character trigrams are hashed into a fixed number of
+# buckets (the hashing trick), weighted with 1 + log(count) and L2 normalized.
+# It is deterministic and needs no network or model file, which also makes it the embedder
+# to use for tests and benchmarks. It matches shared wording rather than meaning, so function
+# words are left out: otherwise "how do I ... on windows" questions about anything end up close.
+# Measured on paraphrases and unrelated messages, paraphrases sharing a content word land under
+# ~0.9 and unrelated pairs above ~1.45, LOCAL_DISTANCE_THRESHOLD sits between them.
+class HashingEmbedder(Embedder):
+    cacheable = False # Computing a vector is cheaper than looking it up
+    max_distance = LOCAL_DISTANCE_THRESHOLD
+
+    STOPWORDS = {
+        "a", "an", "the", "i", "me", "my", "we", "our", "you", "your", "it", "its", "is", "am", "are",
+        "was", "were", "be", "been", "do", "does", "did", "to", "of", "in", "on", "at", "by", "for",
+        "from", "up", "with", "and", "or", "but", "what", "how", "when", "where", "which", "who", "can",
+        "could", "would", "should", "will", "about", "this", "that", "these", "those", "some", "there",
+        "s", "t", "like", "want", "tell", "please",
+    }
+
+    def __init__(self, dim: int = LOCAL_EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"local-hashing-v2-{dim}" # v2: stopwords removed, vectors of v1 aren't comparable
+
+    def features(self, text):
+        words = [word for word in re.findall(r"\w+", text.lower()) if word not in self.STOPWORDS]
+        for word in words:
+            yield "w:" + word
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield "c:" + padded[i:i + 3]
+
+    def embed_one(self, text):
+        counts = {}
+        for feature in self.features(text):
+            h = zlib.crc32(feature.encode("utf-8"))
+            # Low bits pick the bucket, one high bit the sign, so collisions tend to cancel out
+            bucket = h % self.dim
+            sign = 1.0 if h & 0x80000000 else -1.0
+            counts[bucket] = counts.get(bucket, 0.0) + sign
+
+        vector = [0.0] * self.dim
+        for bucket, count in counts.items():
+            if count:
+                vector[bucket] = math.copysign(1 + math.log(abs(count)), count)
+
+        norm = math.sqrt(sum(v * v for v in vector))
+        if norm == 0:
+            return vector
+        return [v / norm for v in vector]
+
+    def embed(self, texts):
+        return [self.embed_one(text) for text in texts]
+
+EMBEDDERS = {
+    "openai": OpenAIEmbedder,
+    "local": HashingEmbedder,
+}
+
+_embedder = None
+
+def get_embedder() -> Embedder:
+    global _embedder
+    if _embedder is None:
+        if EMBEDDER not in EMBEDDERS:
+            raise ValueError(f"Unknown EMBEDDER: {EMBEDDER}. Must be one of: {list(EMBEDDERS)}")
+        _embedder = EMBEDDERS[EMBEDDER]()
+    return _embedder
@@ -0,0 +1,217 @@
+import atexit
+import hashlib
+import queue
+import threading
+import time
+from array import array
+from concurrent.futures import Future
+
+from config import EMBED_BATCH_MAX_CHARS, EMBED_BATCH_SIZE, EMBED_BATCH_WINDOW, EMBED_CACHE_MAX_ENTRIES, EMBED_MAX_RETRIES, EMBED_QUEUE_SIZE
+from storage.db import read, write_async
+from storage.embedders import get_embedder
+from uprint import OutGoingDataType, uprint
+
+_STOP = object()
+
+# Embedding cache
+#
+# Vectors are kept in the embedding_cache table keyed by embedder name + sha256 of the text, so the
+# user message embedded for retrieval is not embedded again when it is stored, and repeated text
+# across chats is embedded once. last_used drives LRU eviction past EMBED_CACHE_MAX_ENTRIES.
+# Texts currently being embedded are tracked in _inflight so concurrent callers share one request.
+
+_inflight = {} # cache key -> Future of the vector
+_inflight_lock = threading.Lock()
+_cache_size = None
+
+def _cache_key(name: str, text: str) -> str:
+    return f"{name}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+def _cache_get(keys: list[str]) -> dict:
+    placeholders = ",".join("?" * len(keys))
+    rows = read(lambda conn: conn.execute(f"SELECT key, embedding FROM embedding_cache WHERE key IN ({placeholders})", keys).fetchall())
+    if not rows:
+        return {}
+
+    hits = [key for key, _ in rows]
+    now = time.time()
+    write_async(lambda conn: conn.executemany("UPDATE embedding_cache SET last_used = ? WHERE key = ?", [(now, key) for key in hits]))
+
+    found = {}
+    for key, blob in rows:
+        vector = array("f")
+        vector.frombytes(blob)
+        found[key] = vector.tolist()
+    return found
+
+def _cache_put(vectors: dict):
+    now = time.time()
+    rows = [(key, array("f", vector).tobytes(), now) for key, vector in vectors.items()]
+    placeholders = ",".join("?" * len(rows))
+
+    # Runs on the writer thread, which keeps _cache_size consistent with the table
+    def task(conn):
+        global _cache_size
+        cursor = conn.cursor()
+        if _cache_size is None:
+            _cache_size = cursor.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+
+        # Replaced keys don't grow the cache
+        existing = cursor.execute(f"SELECT COUNT(*) FROM embedding_cache WHERE key IN ({placeholders})", list(vectors)).fetchone()[0]
+        cursor.executemany("INSERT OR REPLACE INTO embedding_cache (key, embedding, last_used) VALUES (?, ?, ?)", rows)
+        _cache_size += len(rows) - existing
+
+        if _cache_size > EMBED_CACHE_MAX_ENTRIES:
+            # Evict down to 90% so this doesn't run on every insert
+            _cache_size = int(EMBED_CACHE_MAX_ENTRIES * 0.9)
+            cursor.execute("""
+                DELETE FROM embedding_cache WHERE key IN (
+                    SELECT key FROM embedding_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (_cache_size, ))
+
+    write_async(task)
+
+# Returns one embedding per text, only texts that are neither cached nor in flight are sent to the API
+def embed(texts: list[str]) -> list[list[float]]:
+    embedder = get_embedder()
+    if not embedder.cacheable:
+        return embedder.embed(texts)
+
+    keys = [_cache_key(embedder.name, text) for text in texts]
+    found = _cache_get(list(set(keys)))
+
+    missing = {} # key -> text, embedded by this call
+    waiting = {} # key -> Future, embedded by another thread right now
+    with _inflight_lock:
+        for key, text in zip(keys, texts):
+            if key in found or key in missing or key in waiting:
+                continue
+            if key in _inflight:
+                waiting[key] = _inflight[key]
+            else:
+                _inflight[key] = Future()
+                missing[key] = text
+
+    if missing:
+        try:
+            vectors = embedder.embed(list(missing.values()))
+            new = dict(zip(missing, vectors))
+            _cache_put(new)
+            found.update(new)
+            for key, vector in new.items():
+                _inflight[key].set_result(vector)
+        except Exception as e:
+            for key in missing:
+                if not _inflight[key].done():
+                    _inflight[key].set_exception(e)
+            raise
+        finally:
+            with _inflight_lock:
+                for key in missing:
+                    _inflight.pop(key, None)
+
+    for key, future in waiting.items():
+        found[key] = future.result()
+
+    return [found[key] for key in keys]
+
+# Background worker that embeds stored messages and adds them to Chroma.
+#
+# Messages are queued by store_embeddings and grouped until EMBED_BATCH_SIZE messages (or
+# EMBED_BATCH_MAX_CHARS characters) are waiting or EMBED_BATCH_WINDOW seconds have passed since the
+# first one arrived. Each group is one multi-input embeddings request and one chroma add. The queue
+# is bounded, so a burst of messages slows the producer down instead of piling up without limit.
+class EmbeddingWorker(threading.Thread):
+    def __init__(self, collection):
+        super().__init__(name="embedding-worker", daemon=True)
+        self.collection = collection
+        self.jobs = queue.Queue(maxsize=EMBED_QUEUE_SIZE)
+
+    # item: {"id", "document", "metadata"}
+    def submit(self, item):
+        self.jobs.put(item)
+
+    def stop(self):
+        self.jobs.put(_STOP)
+        self.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.jobs.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            chars = len(item["document"])
+            deadline = time.monotonic() + EMBED_BATCH_WINDOW
+
+            while len(batch) < EMBED_BATCH_SIZE and chars < EMBED_BATCH_MAX_CHARS:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.jobs.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                chars += len(item["document"])
+
+            self.flush(batch)
+
+        # Whatever is still queued at shutdown is flushed without waiting for the window
+        rest = []
+        while True:
+            try:
+                item = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                rest.append(item)
+        for i in range(0, len(rest), EMBED_BATCH_SIZE):
+            self.flush(rest[i:i + EMBED_BATCH_SIZE])
+
+    def flush(self, batch):
+        for attempt in range(EMBED_MAX_RETRIES):
+            try:
+                embeddings = embed([item["document"] for item in batch])
+
+                self.collection.add(
+                    embeddings=embeddings,
+                    documents=[item["document"] for item in batch],
+                    ids=[item["id"] for item in batch],
+                    metadatas=[item["metadata"] for item in batch]
+                )
+                return
+            except Exception as e:
+                error = e
+                if attempt < EMBED_MAX_RETRIES - 1:
+                    time.sleep(2 ** attempt)
+
+        uprint(f"[EMBEDDINGS] Dropped {len(batch)} messages after {EMBED_MAX_RETRIES} attempts: {error}", OutGoingDataType.LOG)
+
+_worker = None
+
+def start_embedding_worker(collection):
+    global _worker
+    if _worker is not None:
+        return
+
+    _worker = EmbeddingWorker(collection)
+    _worker.start()
+    atexit.register(stop_embedding_worker)
+
+def stop_embedding_worker():
+    global _worker
+    if _worker is None:
+        return
+
+    _worker.stop()
+    _worker = None
+
+def queue_embedding(item):
+    _worker.submit(item)
@@ -0,0 +1,201 @@
+import json
+import sqlite3
+from datetime import datetime
+
+from config import BASE_PATH
+from storage.db import DB_PATH
+from uprint import OutGoingDataType, uprint
+
+# Versioned schema changes for chat_memory.db
+#
+# The tables created by init_db are version 0. MIGRATIONS[i] upgrades the schema to version i + 1,
+# and the version reached is stored in the database itself (PRAGMA user_version), so every
+# migration runs exactly once per database. Append new migrations to the end, never edit old ones.
+#
+# Migrations run on their own connection with foreign key enforcement off, since SQLite can only
+# change a table's constraints by rebuilding it. Each one commits together with its version bump,
+# after checking that the data still satisfies every foreign key.
+
+# SQLite can't ALTER a foreign key, so the table is copied into a new one with the wanted schema.
+# Rows pointing at a parent that no longer exists are left behind. Dropping the old table also
+# drops its triggers, they are recreated on the new table. The AUTOINCREMENT counter is carried
+# over so ids of deleted rows (still used as chroma ids) are never handed out again.
+def _rebuild_table(cursor, table: str, schema: str, columns: str, where: str = ""):
+    triggers = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (table, )).fetchall()
+    has_sequence = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone()
+    sequence = has_sequence and cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table, )).fetchone()
+
+    cursor.execute(schema.format(table=f"{table}_new"))
+    cursor.execute(f"INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table} {where}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    if sequence:
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table, ))
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, sequence[0]))
+
+    for (sql, ) in triggers:
+        cursor.execute(sql)
+
+# 1: indexes for paging messages and sorting chats, deleting a chat cascades to everything in it
+def _add_indexes_and_cascades(cursor):
+    _rebuild_table(cursor, "messages", """
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            role TEXT,
+            content TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+        )
+    """, "id, chat_id, role, content, timestamp", "WHERE chat_id IN (SELECT id FROM chats)")
+
+    _rebuild_table(cursor, "chat_window_entries", """
+        CREATE TABLE {table} (
+            chat_id INTEGER,
+            position INTEGER,
+            message_id INTEGER,
+            data TEXT,
+            PRIMARY KEY (chat_id, position),
+            FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE,
+            FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE CASCADE
+        )
+    """, "chat_id, position, message_id, data",
+        "WHERE chat_id IN (SELECT id FROM chats) AND (message_id IS NULL OR message_id IN (SELECT id FROM messages))")
+
+    _rebuild_table(cursor, "chat_windows", """
+        CREATE TABLE {table} (
+            chat_id INTEGER PRIMARY KEY,
+            window TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+        )
+    """, "chat_id, window, updated_at", "WHERE chat_id IN (SELECT id FROM chats)")
+
+    # get_chat_messages pages by (chat_id, id), and deleting a chat finds its messages through it
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, id)")
+    # Without it, every cascaded message delete would scan the window entries of all chats
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_window_entries_message_id ON chat_window_entries(message_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_last_modified ON chats(last_modified)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_created_at ON chats(created_at)")
+
+# 2: results of tools declared with @tool(cache_ttl=..., cache_persist=True), see tool_cache.py
+def _add_tool_cache(cursor):
+    cursor.execute("""
+        CREATE TABLE tool_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            expires_at REAL
+        )
+    """)
+    cursor.execute("CREATE INDEX idx_tool_cache_expires_at ON tool_cache(expires_at)")
+
+# 3: the calendar tool's events, moved out of storage/calendar.json. Start times are stored as
+# epoch seconds so range queries and cleanup are index lookups. Past events are not imported.
+def _add_calendar_events(cursor):
+    cursor.execute("""
+        CREATE TABLE calendar_events (
+            id TEXT PRIMARY KEY,
+            event TEXT,
+            start_ts INTEGER
+        )
+    """)
+    cursor.execute("CREATE INDEX idx_calendar_events_start_ts ON calendar_events(start_ts)")
+
+    calendar_file = BASE_PATH / "storage" / "calendar.json"
+    try:
+        entries = json.loads(calendar_file.read_text())
+    except (OSError, ValueError):
+        entries = []
+
+    now = datetime.now().timestamp()
+    rows = []
+    for entry in entries:
+        try:
+            start_ts = int(datetime.fromisoformat(entry["datetime"]).timestamp())
+        except (KeyError, TypeError, ValueError):
+            continue
+        if start_ts > now:
+            rows.append((entry.get("id"), entry.get("event"), start_ts))
+    cursor.executemany("INSERT OR IGNORE INTO calendar_events (id, event, start_ts) VALUES (?, ?, ?)", rows)
+
+# 4: local index of the user's Spotify playlists, filled by the spotify tool's library sync.
+# snapshot_id is what Spotify last reported for a playlist, its tracks are only fetched again when it changes.
+def _add_spotify_library(cursor):
+    cursor.execute("""
+        CREATE TABLE spotify_playlists (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            description TEXT,
+            uri TEXT,
+            snapshot_id TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE spotify_tracks (
+            id INTEGER PRIMARY KEY, -- explicit so VACUUM can't renumber the rows the FTS index points at
+            playlist_id TEXT,
+            position INTEGER,
+            uri TEXT,
+            name TEXT,
+            artists TEXT,
+            album TEXT,
+            album_uri TEXT,
+            added_at TEXT,
+            UNIQUE (playlist_id, position),
+            FOREIGN KEY (playlist_id) REFERENCES spotify_playlists(id) ON DELETE CASCADE
+        )
+    """)
+
+    # Search over track, artist and album names, kept in sync by triggers
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE spotify_tracks_fts USING fts5(name, artists, album, content='spotify_tracks', content_rowid='id')")
+    except sqlite3.OperationalError:
+        return # SQLite built without FTS5, library search falls back to LIKE
+    cursor.execute("""
+        CREATE TRIGGER spotify_tracks_fts_insert AFTER INSERT ON spotify_tracks BEGIN
+            INSERT INTO spotify_tracks_fts(rowid, name, artists, album) VALUES (new.id, new.name, new.artists, new.album);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER spotify_tracks_fts_delete AFTER DELETE ON spotify_tracks BEGIN
+            INSERT INTO spotify_tracks_fts(spotify_tracks_fts, rowid, name, artists, album) VALUES ('delete', old.id, old.name, old.artists, old.album);
+        END
+    """)
+
+MIGRATIONS = [
+    _add_indexes_and_cascades,
+    _add_tool_cache,
+    _add_calendar_events,
+    _add_spotify_library,
+]
+
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# Brings the database up to the latest schema version
+def migrate():
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    try:
+        conn.execute("PRAGMA busy_timeout=5000")
+        version = schema_version(conn)
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = conn.cursor()
+                migration(cursor)
+
+                violations = cursor.execute("PRAGMA foreign_key_check").fetchall()
+                if violations:
+                    raise sqlite3.IntegrityError(f"foreign key violations: {violations[:5]}")
+
+                cursor.execute(f"PRAGMA user_version = {number}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            uprint(f"[DB] migrated schema to version {number}", OutGoingDataType.LOG)
+    finally:
+        conn.close()
@@ -0,0 +1,75 @@
+# Run from backend/: python -m unittest discover tests
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import chromadb
+from storage import chat_storage, embedders
+from storage.embedders import HashingEmbedder
+
+MESSAGES = [
+    "my sister's birthday is in March",
+    "the backend crashes on startup with a KeyError",
+    "I prefer dark mode in editors",
+    "remind me to buy milk and eggs",
+    "what is the capital of France",
+]
+
+def distance(embedder, a, b):
+    x, y = embedder.embed([a, b])
+    return sum((p - q) ** 2 for p, q in zip(x, y))
+
+class LocalEmbedderTest(unittest.TestCase):
+    def setUp(self):
+        self.embedder = HashingEmbedder()
+
+    def test_paraphrases_are_under_the_cutoff(self):
+        pairs = [
+            ("when is my sister's birthday", "my sister's birthday is in March"),
+            ("backend crash when starting", "the backend crashes on startup"),
+            ("which editor theme do I like, dark mode", "I prefer dark mode in editors"),
+        ]
+        for a, b in pairs:
+            self.assertLess(distance(self.embedder, a, b), self.embedder.max_distance, (a, b))
+
+    def test_unrelated_messages_are_over_the_cutoff(self):
+        pairs = [
+            ("what is my sister doing this weekend", "what is the capital of France"),
+            ("how do I install python on windows", "how do I change my password on windows"),
+            ("I want to listen to some music", "I want to learn how to cook pasta"),
+        ]
+        for a, b in pairs:
+            self.assertGreaterEqual(distance(self.embedder, a, b), self.embedder.max_distance, (a, b))
+
+class LocalRetrievalTest(unittest.TestCase):
+    def setUp(self):
+        self.previous = (embedders._embedder, chat_storage.chroma_collection)
+        embedders._embedder = HashingEmbedder()
+
+        client = chromadb.EphemeralClient()
+        collection = client.get_or_create_collection(name=f"test_{self.id().rsplit('.', 1)[-1]}")
+        collection.add(
+            ids=[str(i) for i in range(len(MESSAGES))],
+            documents=MESSAGES,
+            embeddings=embedders._embedder.embed(MESSAGES),
+            metadatas=[{"chat_id": "1", "message_id": i, "role": "user"} for i in range(len(MESSAGES))],
+        )
+        chat_storage.chroma_collection = collection
+
+    def tearDown(self):
+        embedders._embedder, chat_storage.chroma_collection = self.previous
+
+    def test_paraphrase_is_retrieved(self):
+        hits = chat_storage.query_embeddings(2, "when is my sister's birthday?", 3)
+        self.assertEqual([hit["document"] for hit in hits], ["my sister's birthday is in March"])
+
+    def test_unrelated_query_retrieves_nothing(self):
+        self.assertEqual(chat_storage.query_embeddings(2, "how do I cook pasta", 3), [])
+
+    def test_current_chat_is_excluded(self):
+        self.assertEqual(chat_storage.query_embeddings(1, "when is my sister's birthday?", 3), [])
+
+if __name__ == "__main__":
+    unittest.main()
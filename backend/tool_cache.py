@@ -0,0 +1,121 @@
+import functools
+import inspect
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from config import TOOL_CACHE_MAX_ENTRIES
+from storage.db import read, write_async
+from uprint import OutGoingDataType, uprint
+
+# Result cache for tools declared with @tool(cache_ttl=...).
+#
+# Results live in an in-memory LRU keyed by tool name + call key, each with its own expiry time.
+# Tools declared with persist=True are also written to the tool_cache table, so results like the
+# IP location or a paid web search survive a restart. Hits and misses are counted per tool.
+
+_MISS = object()
+
+_entries = OrderedDict() # "tool:key" -> (expires_at, result)
+_lock = threading.Lock()
+stats = {} # tool name -> {"hits", "misses"}
+
+def _count(tool_name: str, outcome: str):
+    counts = stats.setdefault(tool_name, {"hits": 0, "misses": 0})
+    counts[outcome] += 1
+    return counts
+
+# Returns (expires_at, result) or None
+def _read_persisted(key: str):
+    try:
+        row = read(lambda conn: conn.execute("SELECT value, expires_at FROM tool_cache WHERE key = ?", (key, )).fetchone())
+    except Exception:
+        return None # DB not open yet
+    if row is None or row[1] <= time.time():
+        return None
+    return row[1], json.loads(row[0])
+
+def _write_persisted(key: str, result, expires_at: float):
+    try:
+        value = json.dumps(result)
+    except (TypeError, ValueError):
+        return
+
+    def task(conn):
+        conn.execute("INSERT OR REPLACE INTO tool_cache (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at))
+        conn.execute("DELETE FROM tool_cache WHERE expires_at <= ?", (time.time(), ))
+
+    try:
+        write_async(task)
+    except Exception:
+        pass # DB not open yet, the memory cache still has it
+
+def _remember(full_key: str, expires_at: float, result):
+    with _lock:
+        _entries[full_key] = (expires_at, result)
+        _entries.move_to_end(full_key)
+        while len(_entries) > TOOL_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+# Returns the cached result, or _MISS
+def get(tool_name: str, key: str, persist: bool = False):
+    full_key = f"{tool_name}:{key}"
+
+    with _lock:
+        entry = _entries.get(full_key)
+        if entry is not None and entry[0] > time.time():
+            _entries.move_to_end(full_key)
+            counts = _count(tool_name, "hits")
+            uprint(f"[TOOL CACHE] {tool_name} hit ({counts['hits']} hits, {counts['misses']} misses)", OutGoingDataType.LOG)
+            return entry[1]
+        _entries.pop(full_key, None)
+
+    entry = _read_persisted(full_key) if persist else None
+    if entry is None:
+        with _lock:
+            _count(tool_name, "misses")
+        return _MISS
+
+    _remember(full_key, *entry)
+    with _lock:
+        counts = _count(tool_name, "hits")
+    uprint(f"[TOOL CACHE] {tool_name} hit from disk ({counts['hits']} hits, {counts['misses']} misses)", OutGoingDataType.LOG)
+    return entry[1]
+
+def put(tool_name: str, key: str, result, ttl: float, persist: bool = False):
+    full_key = f"{tool_name}:{key}"
+    expires_at = time.time() + ttl
+
+    _remember(full_key, expires_at, result)
+    if persist:
+        _write_persisted(full_key, result, expires_at)
+
+# Wraps fn so its results are cached for ttl seconds.
+# key_fn(arguments) -> str builds the cache key from the bound call arguments (defaults included),
+# by default all of them. cache_if(result) decides whether a result is worth keeping.
+def cached(fn, ttl: float, key_fn=None, persist: bool = False, cache_if=None):
+    sig = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, refresh: bool = False, **kwargs):
+        bound = sig.bind(*args, **kwargs)
+        bound.apply_defaults()
+        if key_fn is not None:
+            key = str(key_fn(bound.arguments))
+        else:
+            key = json.dumps(bound.arguments, sort_keys=True, default=str)
+
+        if not refresh:
+            result = get(fn.__name__, key, persist)
+            if result is not _MISS:
+                return result
+
+        result = fn(*args, **kwargs)
+        # Tools report failures as {"error": ...}, those are never cached unless cache_if says otherwise
+        keep = cache_if(result) if cache_if is not None else not (isinstance(result, dict) and "error" in result)
+        if keep:
+            put(fn.__name__, key, result, ttl, persist)
+        return result
+
+    return wrapper
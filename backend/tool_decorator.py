@@ -1,7 +1,28 @@
 import inspect
-from state import tool_definitions, tool_functions
+import typing
+from state import tool_definitions, tool_functions, tool_parallel_safe
+from tool_cache import cached
 
-def tool(description: str = None):
+# While watcher.py loads a tool module, its tools are collected here (name -> (definition, function,
+# parallel_safe)) instead of going straight into the registry, which the watcher swaps in as a whole
+collector = None
+
+JSON_TYPES = {
+    "int": "integer",
+    "float": "number",
+    "str": "string",
+    "bool": "boolean",
+    "list": "array",
+    "dict": "object"
+}
+
+# parallel_safe=False keeps a tool out of the thread pool, use it for tools that touch shared state
+# (files, calendar, playback) where running two calls at once or out of order would be wrong.
+# cache_ttl (seconds) caches results per set of arguments, cache_key(arguments) -> str narrows what
+# counts as the same call, cache_persist keeps results in the DB across restarts and cache_if(result)
+# picks which results to keep. Cached tools get a refresh argument that bypasses the cache.
+def tool(description: str = None, parallel_safe: bool = True, cache_ttl: float = None, cache_key=None,
+         cache_persist: bool = False, cache_if=None):
     def decorator(fn):
         sig = inspect.signature(fn)
         params_schema = {
@@ -21,17 +42,15 @@ def tool(description: str = None):
             else:
                 param_type = "str"
             
-            json_type = {
-                "int": "integer",
-                "float": "number",
-                "str": "string",
-                "bool": "boolean",
-                "list": "array",
-                "dict": "object"
-            }.get(param_type, "string")
+            json_type = JSON_TYPES.get(param_type, "string")
             
             # Build parameter schema
             param_schema = {"type": json_type}
+            if json_type == "array":
+                # The API rejects arrays without items, list[int] etc. pick the item type
+                item_args = typing.get_args(hint) if hint != inspect.Parameter.empty else ()
+                item_type = getattr(item_args[0], "__name__", "str") if item_args else "str"
+                param_schema["items"] = {"type": JSON_TYPES.get(item_type, "string")}
             if default != inspect.Parameter.empty:
                 param_schema["default"] = default
             params_schema["properties"][name] = param_schema
@@ -39,6 +58,14 @@ def tool(description: str = None):
             if param.default == inspect.Parameter.empty:
                 params_schema["required"].append(name)
 
+        if cache_ttl is not None:
+            params_schema["properties"]["refresh"] = {
+                "type": "boolean",
+                "default": False,
+                "description": "Ignore cached results and fetch fresh data"
+            }
+            fn = cached(fn, cache_ttl, cache_key, cache_persist, cache_if)
+
         tool_def = {
             "type": "function",
             "function": {
@@ -48,7 +75,12 @@ def tool(description: str = None):
             }
         }
 
+        if collector is not None:
+            collector[fn.__name__] = (tool_def, fn, parallel_safe)
+            return fn
+
         tool_definitions.append(tool_def)
         tool_functions[fn.__name__] = fn
+        tool_parallel_safe[fn.__name__] = parallel_safe
         return fn
     return decorator
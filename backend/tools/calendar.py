@@ -1,92 +1,80 @@
-import json
-import os
 import time
 import dateparser
 from datetime import datetime
-from pathlib import Path
-from config import BASE_PATH
 import hashlib
-from threading import Lock
 
+from storage.db import read, write
 from tool_decorator import tool
 
-calendar_lock = Lock()
+# Events live in the calendar_events table of chat_memory.db (storage/migrations.py imported the old
+# calendar.json into it). Times are parsed once when an event is added and stored as epoch seconds,
+# so listing is an index range scan and removing past events is a single DELETE, run on a timer
+# by storage/calendar_cleanup.py.
 
-CALENDAR_FILE = BASE_PATH / "storage" / "calendar.json"
+INSERT_EVENT = "INSERT INTO calendar_events (id, event, start_ts) VALUES (?, ?, ?)"
+DELETE_EVENT = "DELETE FROM calendar_events WHERE id = ?"
+SELECT_EVENTS_BETWEEN = "SELECT id, event, start_ts FROM calendar_events WHERE start_ts > ? AND start_ts < ? ORDER BY start_ts"
 
-def load_calendar():
-    with calendar_lock:
-        if CALENDAR_FILE.exists():
-            with open(CALENDAR_FILE, "r") as f:
-                return json.load(f)
-    return []
+# Far enough in the future for an open ended range
+END_OF_TIME = 2 ** 62
 
 def generate_event_id(event: str, dt: datetime):
     hash_input = f"{event}-{dt.isoformat()}-{time.time()}"
     return hashlib.sha256(hash_input.encode()).hexdigest()[:8]
 
-def save_calendar(entries):
-    with calendar_lock:
-        with open(CALENDAR_FILE, "w") as f:
-            json.dump(entries, f, indent=2)
-            f.flush()
-            os.fsync(f.fileno())
-
-def clean_calendar(entries):
-    now = datetime.now()
-    return [entry for entry in entries if dateparser.parse(entry["datetime"]) > now]
-
 def add_to_calendar(event, datetime_str):
     parsed_time = dateparser.parse(datetime_str)
     if not parsed_time:
         return f"Could not parse datetime: '{datetime_str}'"
 
-    entries = load_calendar()
-    entries = clean_calendar(entries)
-
     entry_id = generate_event_id(event, parsed_time)
-
-    entries.append({
-        "id": entry_id,
-        "event": event,
-        "datetime": parsed_time.isoformat()
-    })
-
-    entries.sort(key=lambda e: e["datetime"])
-    save_calendar(entries)
+    write(lambda conn: conn.execute(INSERT_EVENT, (entry_id, event, int(parsed_time.timestamp()))))
 
     return f"Added event: '{event}' at {parsed_time.strftime('%Y-%m-%d %H:%M')} with ID {entry_id}"
 
 def delete_from_calendar(id):
-    entries = clean_calendar(load_calendar())
-    new_entries = [e for e in entries if e["id"] != id]
+    deleted = write(lambda conn: conn.execute(DELETE_EVENT, (id, )).rowcount)
 
-    if len(new_entries) == len(entries):
+    if not deleted:
         return f"No event found with ID '{id}'."
 
-    save_calendar(new_entries)
     return f"Deleted event with ID '{id}'."
 
-def read_calendar():
-    entries = clean_calendar(load_calendar())
-    save_calendar(entries)
+# Events after start and before end (epoch seconds), past events are never returned
+def events_between(start_ts: int, end_ts: int = END_OF_TIME):
+    start_ts = max(start_ts, int(time.time()))
+    return read(lambda conn: conn.execute(SELECT_EVENTS_BETWEEN, (start_ts, end_ts)).fetchall())
+
+def read_calendar(start_str=None, end_str=None):
+    start_time = dateparser.parse(start_str) if start_str else datetime.now()
+    if not start_time:
+        return f"Could not parse datetime: '{start_str}'"
+
+    end_time = dateparser.parse(end_str) if end_str else None
+    if end_str and not end_time:
+        return f"Could not parse datetime: '{end_str}'"
+
+    start_ts = int(start_time.timestamp())
+    end_ts = int(end_time.timestamp()) if end_time else END_OF_TIME
+
+    entries = events_between(start_ts, end_ts)
     if not entries:
         return "No upcoming events."
 
     return "\n".join(
-        f"[{entry['id']}] {dateparser.parse(entry['datetime']).strftime('%Y-%m-%d %H:%M')}: {entry['event']}"
-        for entry in entries
+        f"[{entry_id}] {datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M')}: {event}"
+        for entry_id, event, start in entries
     )
 
 # Tool Definitions
-@tool("Adds a calendar event at a specified date/time (can be natural language like 'tomorrow at 5pm')")
+@tool("Adds a calendar event at a specified date/time (can be natural language like 'tomorrow at 5pm')", parallel_safe=False)
 def add_event(event:str, datetime_str:str):
     return add_to_calendar(event, datetime_str)
 
-@tool("Returns a list of upcoming calendar events")
-def get_upcoming_events():
-    return read_calendar()
+@tool("Returns a list of upcoming calendar events, optionally only those between start and end (can be natural language like 'next monday')", parallel_safe=False)
+def get_upcoming_events(start:str=None, end:str=None):
+    return read_calendar(start, end)
 
-@tool("Deletes a calendar event by its id (shown as hash during get_upcoming_events)")
+@tool("Deletes a calendar event by its id (shown as hash during get_upcoming_events)", parallel_safe=False)
 def delete_event(id:str):
-    return delete_from_calendar(id)
\ No newline at end of file
+    return delete_from_calendar(id)
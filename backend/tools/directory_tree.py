@@ -1,45 +1,43 @@
-import os
-from config import BASE_PATH
+from config import BASE_PATH, WORKSPACE_TREE_MAX_LINES
+import workspace_index
 from tool_decorator import tool
 
-EXCLUDE_DIRS = {"node_modules", ".git", "dist", "__pycache__"}
-
-@tool("Returns a tree view of a directory up to a given depth")
+@tool("Returns a tree view of a directory up to a given depth, very large trees are cut off")
 def directory_tree(path:str=".", depth:int=3):
     base_path = BASE_PATH / path
     if not base_path.exists():
         return f"Path '{base_path}' does not exist."
 
-    tree_lines = []
+    # Check if base path itself is excluded
+    root_name = base_path.name
+    if root_name in workspace_index.EXCLUDE_DIRS:
+        return f"Path '{base_path}' is excluded."
+
+    tree_lines = [root_name]
 
-    def walk(dir_path, prefix="", level=0):
+    # Returns False once the tree is cut off
+    def walk(dir_path, prefix="", level=1):
         if level > depth:
-            return
+            return True
 
-        try:
-            entries = sorted(os.listdir(dir_path))
-        except PermissionError:
-            return
+        entries = workspace_index.list_dir(dir_path)
 
-        entries = [e for e in entries if e not in EXCLUDE_DIRS]
+        for i, (entry, is_dir) in enumerate(entries):
+            if len(tree_lines) >= WORKSPACE_TREE_MAX_LINES:
+                return False
 
-        for i, entry in enumerate(entries):
-            full_path = os.path.join(dir_path, entry)
             is_last = i == len(entries) - 1
-            connector = "\- " if is_last else "|- "
+            connector = "\\- " if is_last else "|- "
 
             tree_lines.append(f"{prefix}{connector}{entry}")
 
-            if os.path.isdir(full_path):
+            if is_dir:
                 extension = "   " if is_last else "|  "
-                walk(full_path, prefix + extension, level + 1)
+                if not walk(dir_path / entry, prefix + extension, level + 1):
+                    return False
+        return True
 
-    # Check if base path itself is excluded
-    root_name = base_path.name
-    if root_name not in EXCLUDE_DIRS:
-        tree_lines.append(root_name)
-        walk(str(base_path.resolve()), "", 1)
-    else:
-        return f"Path '{base_path}' is excluded."
+    if not walk(base_path.resolve()):
+        tree_lines.append(f"... cut off at {WORKSPACE_TREE_MAX_LINES} lines, list a subdirectory or use a smaller depth (find_files can locate files by name)")
 
     return "\n".join(tree_lines)
@@ -3,7 +3,7 @@ import os
 from config import BASE_PATH
 from tool_decorator import tool
 
-@tool("Executes a shell command")
+@tool("Executes a shell command", parallel_safe=False)
 def execute_shell_command(command: str):
     try:
         result = subprocess.run(
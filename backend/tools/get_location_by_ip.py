@@ -1,11 +1,10 @@
-import requests
-
+import http_client
 from tool_decorator import tool
 
-@tool("Fetches approximate latitude and longitude based on public IP address")
+@tool("Fetches approximate latitude and longitude based on public IP address", cache_ttl=3600, cache_persist=True)
 def get_location_by_ip():
     try:
-        response = requests.get('https://ipinfo.io/json')
+        response = http_client.get('https://ipinfo.io/json')
         response.raise_for_status()
         data = response.json()
         loc = data.get('loc')
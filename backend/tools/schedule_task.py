@@ -4,10 +4,12 @@ from datetime import datetime
 from tool_decorator import tool
 from tools.execute_shell_command import execute_shell_command
 
-scheduler = BackgroundScheduler()
-scheduler.start()
+# Kept when this file is hot-reloaded, so scheduled jobs survive and no second scheduler is started
+if "scheduler" not in globals():
+    scheduler = BackgroundScheduler()
+    scheduler.start()
 
-scheduled_jobs = []
+    scheduled_jobs = []
 
 @tool("Schedules a shell command to run at a specific time using natural language (e.g. 'in 10 minutes', 'tomorrow at 8AM')")
 def schedule_task(command:str, run_at:str):
@@ -1,12 +1,14 @@
 import os
 from pprint import pprint
-import re
 from dotenv import load_dotenv, find_dotenv
 from pathlib import Path
-from serpapi import GoogleSearch
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
+import http_client
+from config import HTTP_TOTAL_TIMEOUT, WEB_FETCH_DEADLINE, WEB_FETCH_MAX_CONCURRENCY, WEB_FETCH_MAX_URLS
+from html_extract import extract_text, header_encoding
+
 from uprint import OutGoingDataType, uprint
 from tool_decorator import tool
 
@@ -27,7 +29,11 @@ def get_serpapi_key():
 
 # Tools
 
-@tool("Performs a web search and returns a list of results")
+# Only actual results are cached, not the missing-key message. Queries differing only in case or
+# surrounding whitespace share an entry
+@tool("Performs a web search and returns a list of results", cache_ttl=3600, cache_persist=True,
+      cache_key=lambda args: f"{args['query'].strip().lower()}|{args['num_results']}",
+      cache_if=lambda result: isinstance(result, list))
 def web_search(query:str, num_results:int=10):
     api_key = get_serpapi_key()
 
@@ -41,8 +47,13 @@ def web_search(query:str, num_results:int=10):
         "num": num_results
     }
 
-    search = GoogleSearch(params)
-    results = search.get_dict()
+    # Same endpoint the serpapi package calls, through the shared client
+    try:
+        response = http_client.get("https://serpapi.com/search.json", params=params)
+        response.raise_for_status()
+        results = response.json()
+    except (requests.RequestException, ValueError) as e:
+        return f"Search failed: {str(e)}"
     organic = results.get("organic_results", [])[:num_results]
     
     organic_results = [
@@ -57,43 +68,42 @@ def web_search(query:str, num_results:int=10):
 
     return organic_results
 
-@tool("Fetches and extracts readable content from a live webpage URL (e.g., https://example.com). This is for retrieving online articles or web data.")
+@tool("Fetches and extracts readable content from a live webpage URL (e.g., https://example.com). This is for retrieving online articles or web data.",
+      cache_ttl=600, cache_if=lambda result: not result.startswith("Request failed"))
 def web_fetch_page(url:str, max_chars:int=5000):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
-    }
     try:
-        response = requests.get(url, headers=headers, timeout=5)
-        response.raise_for_status()
+        return fetch_page(url, max_chars)
     except requests.RequestException as e:
         return f"Request failed: {str(e)}"
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    # Remove non-content elements
-    for tag in soup(['script', 'style', 'noscript', 'header', 'footer', 'nav', 'aside', 'svg']):
-        tag.decompose()
-
-    # Extract meaningful content based on tag importance
-    important_tags = ['header', 'a', 'button' 'h1', 'h2', 'h3', 'h4', 'span', 'p', 'ul', 'li', 'article', 'section']
-    content = []
-
-    for tag in soup.find_all(important_tags):
-        text = tag.get_text(strip=True)
-        if not text:
-            continue
-
-        # Skip junk patterns
-        if re.search(r'\b(menu|close|copy link|embed|embedded|share|copyright|login|log in|subscribe|cookie|advertis|terms|privacy)\b', text, re.IGNORECASE):
-            continue
-
-        # For anchor tags, include href
-        if tag.name == 'a' and tag.has_attr('href'):
-            href = tag['href']
-            content.append(f"{text} ({href})")
-        else:
-            content.append(text)
-
-    combined = '\n'.join(content)
-
-    return combined[:max_chars]
\ No newline at end of file
+@tool("Fetches several webpage URLs at once and extracts their readable content. Prefer this over calling web_fetch_page repeatedly, e.g. for the links returned by web_search.")
+def web_fetch_pages(urls:list[str], max_chars:int=3000):
+    urls, skipped = urls[:WEB_FETCH_MAX_URLS], urls[WEB_FETCH_MAX_URLS:]
+    if not urls:
+        return []
+
+    def fetch(url):
+        try:
+            return {"url": url, "content": fetch_page(url, max_chars, WEB_FETCH_DEADLINE)}
+        except requests.RequestException as e:
+            return {"url": url, "error": f"Request failed: {str(e)}"}
+
+    # map keeps the input order, each fetch gives up on its own after WEB_FETCH_DEADLINE
+    with ThreadPoolExecutor(max_workers=min(WEB_FETCH_MAX_CONCURRENCY, len(urls))) as pool:
+        pages = list(pool.map(fetch, urls))
+
+    # The model is told what wasn't fetched so it can ask for those in another call
+    if skipped:
+        pages.append({"skipped": skipped, "note": f"Only {WEB_FETCH_MAX_URLS} urls are fetched per call, these were not fetched."})
+    return pages
+
+# Raises requests.RequestException when the page can't be fetched
+def fetch_page(url: str, max_chars: int, deadline: float = HTTP_TOTAL_TIMEOUT) -> str:
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
+    }
+    with http_client.stream("GET", url, headers=headers, deadline=deadline) as response:
+        response.raise_for_status()
+        # The download stops as soon as max_chars of text is extracted
+        chunks = http_client.iter_chunks(response, truncate=True, chunk_size=16 * 1024)
+        return extract_text(chunks, max_chars, header_encoding(response.headers.get("Content-Type")))
@@ -1,27 +1,42 @@
 from importlib import util
-import json
 import os
 import platform
+import re
+import sqlite3
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
 import psutil
 from uprint import uprint, OutGoingDataType
-from config import OS_NAME
+from config import HTTP_MAX_RETRY_AFTER, OS_NAME, SPOTIFY_MAX_RETRIES, SPOTIFY_PAGE_CONCURRENCY, SPOTIFY_QUEUE_CONCURRENCY
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv, find_dotenv
 import ctypes
-from pathlib import Path
 
+import http_client
+from storage.db import read, write
 from tool_decorator import tool
 
-STORAGE_PATH = Path(__file__).resolve().parent / "storage"
-STORAGE_PATH.mkdir(exist_ok=True)
+# The client is created by the first spotify_launch and reused after that, a background timer
+# refreshes its access token shortly before it expires so no tool call waits on a refresh.
+# spotify_pid remembers a Spotify process, checking it is still alive is much cheaper than scanning
+# every process. library_synced is set once the background library sync has started.
+# All three are kept when this file is hot-reloaded.
+if "sp" not in globals():
+    sp = None
+    spotify_pid = None
+    library_synced = False
 
-SPOTIFY_JSON = STORAGE_PATH / "spotify.json"
+TOKEN_REFRESH_MARGIN = 30 # seconds before expiry, spotipy refreshes tokens within 60s of it
+TOKEN_REFRESH_RETRY = 60 # seconds, when the token couldn't be checked or refreshed
 
-sp = None # Initialized during spotify_launch
+# When Spotify answers 429, every thread holds off until the Retry-After it sent has passed
+rate_limited_until = 0
+rate_limit_lock = threading.Lock()
 
 dotenv_path = find_dotenv()
 
@@ -83,74 +98,220 @@ def open_spotify_app():
     except Exception as e:
         return f"Failed to launch Spotify: {str(e)}"
 
-def spotify_get_playlist_tracks(playlist_id):
-    spotify_launch()
-
-    results = sp.playlist_tracks(playlist_id)
-    tracks = []
-
-    for item in results["items"]:
-        track = item["track"]
-        images = track["album"].get("images", [])
-        image_url = images[0]["url"] if images else None
-
-        tracks.append({
-            "date-added": item["added_at"],
-            "name": track["name"],
-            "artists": [a["name"] for a in track["artists"]],
-            "uri": track["uri"],
-            "album-id": track["album"]["id"],
-            "album-name": track["album"]["name"],
-            "image_url": image_url,
-            "explicit": track["explicit"],
-            "popularity": track["popularity"]
-        })
-    
-    return tracks
+def is_spotify_running():
+    global spotify_pid
+
+    if spotify_pid is not None:
+        try:
+            if "spotify" in psutil.Process(spotify_pid).name().lower():
+                return True
+        except psutil.Error:
+            pass
+        spotify_pid = None
+
+    for p in psutil.process_iter(["name"]):
+        if "spotify" in (p.info["name"] or "").lower():
+            spotify_pid = p.pid
+            return True
+    return False
+
+def refresh_token():
+    delay = TOKEN_REFRESH_RETRY
+    try:
+        auth_manager = sp.auth_manager
+        token = auth_manager.validate_token(auth_manager.cache_handler.get_cached_token())
+        if token:
+            delay = max(token["expires_at"] - time.time() - TOKEN_REFRESH_MARGIN, 10)
+    except Exception:
+        pass
+
+    timer = threading.Timer(delay, refresh_token)
+    timer.daemon = True
+    timer.start()
+
+# Calls fn(*args, **kwargs) against the API, waiting out rate limits and retrying on 429
+def call_api(fn, *args, **kwargs):
+    global rate_limited_until
+
+    for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+        wait = rate_limited_until - time.monotonic()
+        if wait > 0:
+            sleep(wait)
+
+        try:
+            return fn(*args, **kwargs)
+        except spotipy.SpotifyException as e:
+            if e.http_status != 429 or attempt == SPOTIFY_MAX_RETRIES:
+                raise
+            retry_after = (e.headers or {}).get("Retry-After", "1")
+            retry_after = int(retry_after) if str(retry_after).isdigit() else 1
+            if retry_after > HTTP_MAX_RETRY_AFTER:
+                raise
+            with rate_limit_lock:
+                rate_limited_until = max(rate_limited_until, time.monotonic() + retry_after)
+
+# Returns the items of every page of a paged endpoint. fetch_page(offset) returns one page, the
+# first one tells how many items there are and the rest are fetched in parallel.
+def fetch_all_pages(fetch_page, page_size: int):
+    first = call_api(fetch_page, 0)
+    offsets = range(page_size, first.get("total") or 0, page_size)
+
+    with ThreadPoolExecutor(max_workers=SPOTIFY_PAGE_CONCURRENCY) as pool:
+        pages = list(pool.map(lambda offset: call_api(fetch_page, offset), offsets))
+
+    return [item for page in [first] + pages for item in page["items"]]
+
+# Offline library index
+#
+# The user's playlists and their tracks are mirrored into spotify_playlists / spotify_tracks in
+# chat_memory.db (with an FTS index over track, artist and album names), so spotify_search_library
+# answers "that song from my X playlist" without calling the API. A sync fetches the playlist list
+# and only re-reads the tracks of playlists whose snapshot_id changed, pages in parallel.
+
+SELECT_SNAPSHOTS = "SELECT id, snapshot_id FROM spotify_playlists"
+UPSERT_PLAYLIST = """
+    INSERT INTO spotify_playlists (id, name, description, uri, snapshot_id) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET name = excluded.name, description = excluded.description,
+        uri = excluded.uri, snapshot_id = excluded.snapshot_id
+"""
+DELETE_PLAYLIST = "DELETE FROM spotify_playlists WHERE id = ?"
+DELETE_PLAYLIST_TRACKS = "DELETE FROM spotify_tracks WHERE playlist_id = ?"
+INSERT_TRACK = """
+    INSERT INTO spotify_tracks (playlist_id, position, uri, name, artists, album, album_uri, added_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SELECT_LIBRARY_MATCHES = """
+    SELECT t.name, t.artists, t.album, t.uri, t.album_uri, p.name
+    FROM spotify_tracks_fts JOIN spotify_tracks t ON t.id = spotify_tracks_fts.rowid
+    JOIN spotify_playlists p ON p.id = t.playlist_id
+    WHERE spotify_tracks_fts MATCH ? AND p.name LIKE ?
+    ORDER BY bm25(spotify_tracks_fts)
+    LIMIT ?
+"""
+# Without FTS5, every word has to appear in the track, artist or album name
+SELECT_LIBRARY_LIKE = """
+    SELECT t.name, t.artists, t.album, t.uri, t.album_uri, p.name
+    FROM spotify_tracks t JOIN spotify_playlists p ON p.id = t.playlist_id
+    WHERE {conditions} AND p.name LIKE ?
+    LIMIT ?
+"""
+TRACK_FIELDS = "total,items(added_at,track(uri,name,artists(name),album(name,uri)))"
+
+def fetch_playlist_tracks(playlist_id):
+    items = fetch_all_pages(lambda offset: sp.playlist_items(
+        playlist_id, fields=TRACK_FIELDS, limit=100, offset=offset
+    ), 100)
+
+    rows = []
+    for position, item in enumerate(items):
+        track = item.get("track")
+        if not track or not track.get("uri"):
+            continue
+        album = track.get("album") or {}
+        rows.append((
+            playlist_id,
+            position,
+            track["uri"],
+            track.get("name"),
+            ", ".join(a["name"] for a in track.get("artists", [])),
+            album.get("name"),
+            album.get("uri"),
+            item.get("added_at"),
+        ))
+    return rows
+
+# Brings the library index up to date, returns (playlists, playlists re-read, tracks indexed)
+def sync_library():
+    playlists = fetch_all_pages(lambda offset: sp.current_user_playlists(limit=50, offset=offset), 50)
+    known = dict(read(lambda conn: conn.execute(SELECT_SNAPSHOTS).fetchall()))
+
+    changed = [pl for pl in playlists if known.get(pl["id"]) != pl.get("snapshot_id")]
+    with ThreadPoolExecutor(max_workers=SPOTIFY_PAGE_CONCURRENCY) as pool:
+        tracks = dict(zip((pl["id"] for pl in changed), pool.map(fetch_playlist_tracks, (pl["id"] for pl in changed))))
+
+    removed = set(known) - {pl["id"] for pl in playlists}
+
+    def task(conn):
+        cursor = conn.cursor()
+        cursor.executemany(DELETE_PLAYLIST, [(playlist_id, ) for playlist_id in removed])
+        for pl in changed:
+            cursor.execute(UPSERT_PLAYLIST, (pl["id"], pl["name"], pl.get("description"), pl["uri"], pl.get("snapshot_id")))
+            cursor.execute(DELETE_PLAYLIST_TRACKS, (pl["id"], ))
+            cursor.executemany(INSERT_TRACK, tracks[pl["id"]])
+
+    write(task)
+    return len(playlists), len(changed), sum(len(rows) for rows in tracks.values())
+
+def sync_library_in_background():
+    def run():
+        try:
+            total, changed, indexed = sync_library()
+            uprint(f"[SPOTIFY] Library synced: {changed} of {total} playlists updated, {indexed} tracks indexed", OutGoingDataType.LOG)
+        except Exception as e:
+            uprint(f"[SPOTIFY] Library sync failed: {e}", OutGoingDataType.LOG)
+
+    threading.Thread(target=run, daemon=True).start()
+
+def search_library(query: str, playlist: str = None, limit: int = 10):
+    words = re.findall(r"\w+", query.lower())
+    if not words:
+        return []
+    playlist_pattern = f"%{playlist}%" if playlist else "%"
+
+    def task(conn):
+        try:
+            match = " ".join(f'"{word}"*' for word in words)
+            return conn.execute(SELECT_LIBRARY_MATCHES, (match, playlist_pattern, limit)).fetchall()
+        except sqlite3.OperationalError:
+            conditions = " AND ".join(["(t.name LIKE ? OR t.artists LIKE ? OR t.album LIKE ?)"] * len(words))
+            params = [f"%{word}%" for word in words for _ in range(3)]
+            return conn.execute(SELECT_LIBRARY_LIKE.format(conditions=conditions), (*params, playlist_pattern, limit)).fetchall()
 
-def save_all_playlists_to_json():
-    playlists_data = []
-    
-    for playlist in spotify_get_playlists():
-        tracks = spotify_get_playlist_tracks(playlist["id"])
-        print(playlist)
-        playlists_data.append({
-            "name": playlist["name"],
-            "description": playlist["description"],
-            "tracks": tracks
-        })
-
-    with open(SPOTIFY_JSON, "w", encoding="utf-8") as f:
-        json.dump(playlists_data, f, indent=2, ensure_ascii=False)
-        print(f"Saved {len(playlists_data)} playlists to {SPOTIFY_JSON}")
+    return [
+        {"name": name, "artists": artists, "album": album, "uri": uri, "album_uri": album_uri, "playlist": playlist_name}
+        for name, artists, album, uri, album_uri, playlist_name in read(task)
+    ]
+
+# Spotify gets its own session that doesn't retry 429, rate limits are handled by call_api only
+def create_client(client_id, client_secret):
+    session = http_client.build_session(status_forcelist=http_client.SERVER_ERRORS)
+    return spotipy.Spotify(auth_manager=SpotifyOAuth(
+        client_id=client_id,
+        client_secret=client_secret,
+        redirect_uri="http://127.0.0.1:8888/callback",
+        scope="user-modify-playback-state playlist-modify-public playlist-modify-private user-library-read user-read-playback-state",
+        requests_session=session,
+        requests_timeout=http_client.TIMEOUT
+    ), requests_session=session, requests_timeout=http_client.TIMEOUT)
 
 # Tool Definitions
 
 # Returns None if successful, otherwise returns message to be forwarded.
-@tool("Launches the Spotify desktop app. Must be installed the machine.")
+@tool("Launches the Spotify desktop app. Must be installed the machine.", parallel_safe=False)
 def spotify_launch():
-    global sp
-    
-    client_id, client_secret = get_spotify_credentials()
+    global sp, library_synced
 
-    if client_id == None or client_secret == None:
-        return "client_id or client_secret missing from .env file. A window has opened up in the frontend prompting the user for their credentials."
+    if sp is None:
+        client_id, client_secret = get_spotify_credentials()
 
-    sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-        client_id=client_id,
-        client_secret=client_secret,
-        redirect_uri="http://127.0.0.1:8888/callback",
-        scope="user-modify-playback-state playlist-modify-public playlist-modify-private user-library-read user-read-playback-state"
-    ))
+        if client_id == None or client_secret == None:
+            return "client_id or client_secret missing from .env file. A window has opened up in the frontend prompting the user for their credentials."
+
+        sp = create_client(client_id, client_secret)
+        refresh_token()
+
+    # Without a cached token the first API call runs the OAuth flow, with its callback server on port
+    # 8888. A background sync would start a second flow next to the tool's, so it waits for a token.
+    if not library_synced and sp.auth_manager.cache_handler.get_cached_token():
+        library_synced = True
+        sync_library_in_background()
 
-    # Is spotify running?
-    spotify_running = any("spotify" in p.name().lower() for p in psutil.process_iter())
-    if not spotify_running:
+    if not is_spotify_running():
         open_spotify_app()
-    
+
     return None
 
-@tool("Returns the list of tracks in a given album uri")
+@tool("Returns the list of tracks in a given album uri", parallel_safe=False)
 def spotify_get_album_tracks(uri: str):
     if (result := spotify_launch()): return result
 
@@ -174,7 +335,7 @@ def spotify_get_album_tracks(uri: str):
     except spotipy.SpotifyException as e:
         return f"Failed to get album tracks: {str(e)}"
 
-@tool("Returns the user's Spotify playlists.")
+@tool("Returns the user's Spotify playlists.", parallel_safe=False)
 def spotify_get_playlists(limit:int=10):
     if (result := spotify_launch()): return result
 
@@ -184,7 +345,7 @@ def spotify_get_playlists(limit:int=10):
         for pl in playlists
     ]
 
-@tool("Toggles Spotify playback: pauses if playing, plays if paused (launches spotify automatically if it isn't already open)")
+@tool("Toggles Spotify playback: pauses if playing, plays if paused (launches spotify automatically if it isn't already open)", parallel_safe=False)
 def spotify_toggle_play_pause():
     if (result := spotify_launch()): return result
 
@@ -204,7 +365,7 @@ def spotify_toggle_play_pause():
         sp.pause_playback()
         return f"Paused: {song_name} by {artists}"
 
-@tool("Returns the user's currently playing Spotify song (launches spotify automatically if it isn't already open)")
+@tool("Returns the user's currently playing Spotify song (launches spotify automatically if it isn't already open)", parallel_safe=False)
 def spotify_get_current_song():
     if (result := spotify_launch()): return result
 
@@ -252,7 +413,7 @@ def spotify_get_current_song():
 #             "message": f"Failed to add tracks to playlist: {str(e)}"
 #         }
 
-@tool("Plays a spotify song, album, or playlist by its uri (launches spotify automatically if it isn't already open)")
+@tool("Plays a spotify song, album, or playlist by its uri (launches spotify automatically if it isn't already open)", parallel_safe=False)
 def spotify_play_uri(uri: str):
     if (result := spotify_launch()): return result
 
@@ -272,7 +433,7 @@ def spotify_play_uri(uri: str):
 def spotify_get_new_releases():
     sp.search()
 
-@tool("Gets user's library of favorite albums (launches spotify automatically if it isn't already open)")
+@tool("Gets user's library of favorite albums (launches spotify automatically if it isn't already open)", parallel_safe=False)
 def spotify_get_user_saved_albums(limit:int=10):
     if (result := spotify_launch()): return result
 
@@ -296,7 +457,7 @@ def spotify_get_user_saved_albums(limit:int=10):
     except spotipy.SpotifyException as e:
         return f"Failed to fetch saved albums: {str(e)}"
 
-@tool("Search on spotify, returns top results from tracks and albums (launches spotify automatically if it isn't already open)")
+@tool("Search on spotify, returns top results from tracks and albums (launches spotify automatically if it isn't already open)", parallel_safe=False)
 def spotify_search(query:str, limit:int=5):
     if (result := spotify_launch()): return result
 
@@ -341,33 +502,77 @@ def spotify_search(query:str, limit:int=5):
         return f"Search failed: {str(e)}"
 
 
-@tool("Queues a spotify song, album, or playlist by its uri (launches spotify automatically if it isn't already open)")
-def spotify_add_queue(uri):
+# Adds uris to the queue, at most `concurrency` requests at a time. Progress goes to the log.
+# Returns how many were queued.
+def queue_uris(uris, concurrency: int):
+    queued = 0
+    done = 0
+    last_report = time.monotonic()
+    lock = threading.Lock()
+
+    def add(uri):
+        nonlocal queued, done, last_report
+        try:
+            call_api(sp.add_to_queue, uri)
+            ok = True
+        except spotipy.SpotifyException:
+            ok = False
+
+        with lock:
+            done += 1
+            queued += ok
+            if time.monotonic() - last_report > 1 and done < len(uris):
+                last_report = time.monotonic()
+                uprint(f"[SPOTIFY] Queued {done}/{len(uris)}", OutGoingDataType.LOG)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(add, uris))
+
+    return queued
+
+@tool("Queues a spotify song, album, or playlist by its uri (launches spotify automatically if it isn't already open). "
+      "Set keep_order to false when the order of an album or playlist doesn't matter, it queues faster.", parallel_safe=False)
+def spotify_add_queue(uri: str, keep_order: bool = True):
     if (result := spotify_launch()): return result
 
     try:
         if uri.startswith("spotify:track") or uri.startswith("spotify:episode:"):
-            sp.add_to_queue(uri)
+            call_api(sp.add_to_queue, uri)
             return f"Queued 1 item: {uri}"
         elif uri.startswith("spotify:album:"):
             album_id = uri.split(":")[-1]
-            album = sp.album(album_id)
-            tracks = album["tracks"]["items"]
+            tracks = fetch_all_pages(lambda offset: sp.album_tracks(album_id, limit=50, offset=offset), 50)
         elif uri.startswith("spotify:playlist:"):
             playlist_id = uri.split(":")[-1]
-            playlist = sp.playlist_tracks(playlist_id)
-            tracks = [item["track"] for item in playlist["items"] if item["track"]]
+            items = fetch_all_pages(lambda offset: sp.playlist_items(
+                playlist_id, fields="total,items(track(uri))", limit=100, offset=offset
+            ), 100)
+            tracks = [item["track"] for item in items if item.get("track")]
         else:
             return f"Unsupported context type for queueing: {uri}"
 
-        queued = 0
-        for track in tracks:
-            try:
-                sp.add_to_queue(track["uri"])
-                queued += 1
-            except spotipy.SpotifyException:
-                pass
+        # Each request appends to the end of the queue, so only one at a time keeps the order
+        uris = [track["uri"] for track in tracks if track.get("uri")]
+        queued = queue_uris(uris, 1 if keep_order else SPOTIFY_QUEUE_CONCURRENCY)
 
-        return f"Queued {queued} tracks from {uri}"
+        return f"Queued {queued} of {len(uris)} tracks from {uri}"
     except spotipy.SpotifyException as e:
         return f"Failed to queue context: {str(e)}"
+
+@tool("Searches the user's own Spotify playlists offline by track, artist or album name, optionally only in playlists whose name contains `playlist`. "
+      "Use it for songs the user has saved (e.g. \"that song from my gym playlist\"), then play or queue the returned uri.")
+def spotify_search_library(query: str, playlist: str = None, limit: int = 10):
+    results = search_library(query, playlist, limit)
+    if not results:
+        return "No matching tracks in the local library index. It is synced once Spotify has been used, spotify_sync_library updates it now."
+    return results
+
+@tool("Updates the local index of the user's Spotify playlists used by spotify_search_library (launches spotify automatically if it isn't already open)", parallel_safe=False)
+def spotify_sync_library():
+    if (result := spotify_launch()): return result
+
+    try:
+        total, changed, indexed = sync_library()
+        return f"Library synced: {changed} of {total} playlists updated, {indexed} tracks indexed."
+    except spotipy.SpotifyException as e:
+        return f"Library sync failed: {str(e)}"
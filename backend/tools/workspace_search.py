@@ -0,0 +1,21 @@
+from config import BASE_PATH, WORKSPACE_FIND_MAX_RESULTS, WORKSPACE_SEARCH_MAX_RESULTS
+import workspace_index
+from tool_decorator import tool
+
+@tool("Finds files and directories in the workspace by fuzzy matching their path (e.g. 'spot tool' finds tools/spotify.py), best matches first")
+def find_files(query:str, limit:int=20):
+    limit = max(1, min(limit, WORKSPACE_FIND_MAX_RESULTS))
+    paths = workspace_index.find(query, limit)
+    if not paths:
+        return f"No paths match '{query}'."
+    return "\n".join(paths)
+
+@tool("Searches the contents of the text files under a directory of the workspace for a string (case insensitive), returns matching lines as file:line: text")
+def search_files(query:str, path:str=".", limit:int=50):
+    limit = max(1, min(limit, WORKSPACE_SEARCH_MAX_RESULTS))
+    matches, more = workspace_index.search(query, BASE_PATH / path, limit)
+    if not matches:
+        return f"No matches for '{query}'."
+    if more:
+        matches.append(f"... more than {limit} matches, use a narrower query or path")
+    return "\n".join(matches)
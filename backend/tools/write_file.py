@@ -2,7 +2,7 @@ from config import BASE_PATH
 from pathlib import Path
 from tool_decorator import tool
 
-@tool("Writes content to a file at the given path")
+@tool("Writes content to a file at the given path", parallel_safe=False)
 def write_file(path:str, content:str):
     try:
         file_path = BASE_PATH / Path(path)
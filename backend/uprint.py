@@ -1,4 +1,5 @@
 import json
+import threading
 from enum import Enum
 
 class OutGoingDataType(str, Enum):
@@ -6,10 +7,16 @@ class OutGoingDataType(str, Enum):
     PROMPT = "prompt"
     
     MESSAGE = "assistant-message"
+    MESSAGE_DELTA = "assistant-message-delta" # payload: next chunk of text of a streamed reply
+    MESSAGE_DONE = "assistant-message-done" # payload: full text of the streamed reply
     TOOL_CALL = "tool-call"
     TOOL_RETURN = "tool-return"
     LOG = "log"
     RETURN_ALL_CHATS = "return-all-chats" # payload: id, name, and time-created of all chats
+    CHAT_TOUCHED = "chat-touched" # payload: id, name, and time-created of a chat that moved to the top of the list (new or modified)
+    CHAT_RENAMED = "chat-renamed" # payload: id and new name of a chat
+    CHAT_DELETED = "chat-deleted" # payload: id of a deleted chat
+    TOOLS_CHANGED = "tools-changed" # payload: added and changed tool schemas, names of removed tools
     RETURN_CURRENT_CHAT_ID = "return-current-chat-id" # payload: id of current chat
     
     # Returns from switch-chat
@@ -23,6 +30,9 @@ class OutGoingDataType(str, Enum):
 
     EMPHERAL_RESPONSE = "empheral-response" # response to empheral thread
     
+# Tools can run on worker threads, keep each json line in one piece on stdout
+_print_lock = threading.Lock()
+
 def uprint(msg: str, msg_type=OutGoingDataType.MESSAGE, meta=None):
     if msg == None:
         return
@@ -38,7 +48,8 @@ def uprint(msg: str, msg_type=OutGoingDataType.MESSAGE, meta=None):
     if meta is not None:
         payload["meta"] = meta
 
-    try:
-        print(json.dumps(payload), flush=True)
-    except:
-        print(payload, flush=True)
\ No newline at end of file
+    with _print_lock:
+        try:
+            print(json.dumps(payload), flush=True)
+        except:
+            print(payload, flush=True)
\ No newline at end of file
@@ -1,43 +1,251 @@
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from pathlib import Path
+import hashlib
 import importlib.util
-import sys
-from uprint import uprint
-from state import tool_definitions, tool_functions
+import json
+import os
+import threading
+import time
+import traceback
+import tool_decorator
+import workspace_index
+from config import TOOL_RELOAD_DEBOUNCE
+from uprint import OutGoingDataType, uprint
+from state import tool_definitions, tool_functions, tool_parallel_safe, tools_lock
 
 TOOLS_DIR = Path(__file__).parent / "tools"
+MANIFEST_PATH = Path(__file__).parent / "storage" / "tool_manifest.json"
 
-def load_tools():
-    tool_definitions.clear()
-    tool_functions.clear()
+# Tools are tracked per module so a change to one file only re-imports that file.
+# A module is executed again in its existing namespace (like importlib.reload), so module level
+# state such as the scheduler in schedule_task.py can survive its own reload.
+# The registry in state.py is only replaced while holding tools_lock, which chat() holds for the
+# whole turn, so a turn never sees half of a reload. Modules are loaded under load_lock, which is
+# released before waiting on tools_lock: tools called mid-turn may need load_lock (LazyTool).
+modules = {} # module name -> module object
+module_tools = {} # module name -> {tool name: (definition, function, parallel_safe)}
+load_lock = threading.Lock()
+# Registry snapshots are numbered under load_lock, a snapshot older than the registry isn't swapped in
+generation = 0
+swapped_generation = 0
+
+# Startup doesn't import tools/ at all when it can help it. The schemas @tool builds are cached in
+# MANIFEST_PATH per module, keyed by the sha256 of the file. A module whose file still matches its
+# entry is registered from the manifest with LazyTool stand-ins, and only imported (with its heavy
+# dependencies) the first time one of its tools is called. Changed or new files are imported as before.
+# The schemas also depend on tool_decorator.py, the whole manifest is dropped when that file changes.
+manifest = {} # module name -> {"hash", "tools": {tool name: {"definition", "parallel_safe"}}}
+
+def file_hash(file: Path) -> str:
+    return hashlib.sha256(file.read_bytes()).hexdigest()
+
+DECORATOR_HASH = file_hash(Path(tool_decorator.__file__))
+
+def read_manifest():
+    try:
+        saved = json.loads(MANIFEST_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(saved, dict) or saved.get("decorator") != DECORATOR_HASH:
+        return {}
+    return saved.get("modules", {})
+
+def write_manifest():
+    tmp = MANIFEST_PATH.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"decorator": DECORATOR_HASH, "modules": manifest}, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, MANIFEST_PATH)
+
+def record_module(module_name: str, digest: str, tools: dict):
+    manifest[module_name] = {
+        "hash": digest,
+        "tools": {name: {"definition": definition, "parallel_safe": safe} for name, (definition, _, safe) in tools.items()},
+    }
+
+class LazyTool:
+    def __init__(self, module_name: str, tool_name: str):
+        self.module_name = module_name
+        self.tool_name = tool_name
 
-    for file in TOOLS_DIR.glob("*.py"):
-        module_name = file.stem
+    def __call__(self, **kwargs):
+        # A module that fails to import is the model's tool error, not the end of the turn. It stays
+        # unloaded, so the next call tries again (e.g. after the file was fixed).
+        try:
+            tools = import_lazy_module(self.module_name)
+        except Exception:
+            uprint(f"[TOOLS] failed to load {self.module_name}.py:\n{traceback.format_exc()}", OutGoingDataType.LOG)
+            return f"Tool {self.tool_name} is unavailable: its module failed to load."
+        _, fn, _ = tools.get(self.tool_name, (None, None, None))
+        if fn is None or fn is self:
+            return f"Tool {self.tool_name} not found."
+        return fn(**kwargs)
 
-        # Ensure it's reloaded fresh
-        if module_name in sys.modules:
-            del sys.modules[module_name]
+# Imports a module registered from the manifest and returns its real tools. The registry entries
+# keep pointing at the LazyTools (the registry can't be swapped mid-turn), which now forward to them.
+def import_lazy_module(module_name: str) -> dict:
+    if module_name in modules:
+        return module_tools.get(module_name, {})
 
+    with load_lock:
+        tools = module_tools.get(module_name, {})
+        if module_name in modules:
+            return tools
+
+        file = TOOLS_DIR / f"{module_name}.py"
+        digest = file_hash(file)
+        loaded = load_module(file)
+        record_module(module_name, digest, loaded)
+        write_manifest()
+
+        # Schemas the model already has stay as they are until the next reload
+        tools.update({name: entry for name, entry in loaded.items() if name in tools})
+        return tools
+
+def load_module(file: Path) -> dict:
+    module_name = file.stem
+    module = modules.get(module_name)
+    if module is None:
         spec = importlib.util.spec_from_file_location(module_name, file)
         module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-    
+
+    tool_decorator.collector = {}
+    try:
+        module.__spec__.loader.exec_module(module)
+        modules[module_name] = module
+        # Tools of other modules it imports (e.g. tools.execute_shell_command) belong to those modules
+        return {name: entry for name, entry in tool_decorator.collector.items() if entry[1].__module__ == module_name}
+    finally:
+        tool_decorator.collector = None
+
+# The tools of every loaded module, with its generation. Call with load_lock held.
+def snapshot_registry():
+    global generation
+    tools = {}
+    for collected in module_tools.values():
+        tools.update(collected)
+    generation += 1
+    return generation, tools
+
+# Replaces the registry with a snapshot and tells the frontend what changed. Must not be called with
+# load_lock held, this waits for the current turn to finish. The initial load isn't a change and
+# reports nothing, TOOLS_CHANGED is only for reloads while the backend runs.
+def swap_registry(snapshot):
+    global swapped_generation
+    snapshot_generation, tools = snapshot
+
+    with tools_lock:
+        if snapshot_generation < swapped_generation:
+            return # A later reload already swapped in a newer registry
+        initial = swapped_generation == 0
+        swapped_generation = snapshot_generation
+        old = {d["function"]["name"]: d for d in tool_definitions}
+
+        tool_definitions[:] = [definition for definition, _, _ in tools.values()]
+        tool_functions.clear()
+        tool_functions.update({name: fn for name, (_, fn, _) in tools.items()})
+        tool_parallel_safe.clear()
+        tool_parallel_safe.update({name: safe for name, (_, _, safe) in tools.items()})
+
+    new = {name: definition for name, (definition, _, _) in tools.items()}
+    diff = {
+        "added": [new[name] for name in new if name not in old],
+        "changed": [new[name] for name in new if name in old and new[name] != old[name]],
+        "removed": [name for name in old if name not in new],
+    }
+    if not initial and any(diff.values()):
+        uprint(diff, OutGoingDataType.TOOLS_CHANGED)
+
+# Re-imports the given tool files (or drops them if they are gone) and swaps the registry once.
+# A module that fails to import keeps its previous tools. With lazy=True, files matching their
+# manifest entry are registered from it without being imported.
+def reload_modules(files, lazy: bool = False):
+    imported = 0
+    with load_lock:
+        for file in files:
+            module_name = file.stem
+            if not file.exists():
+                modules.pop(module_name, None)
+                module_tools.pop(module_name, None)
+                manifest.pop(module_name, None)
+                continue
+
+            digest = file_hash(file)
+            cached = manifest.get(module_name)
+            if lazy and cached and cached["hash"] == digest:
+                module_tools[module_name] = {
+                    name: (tool["definition"], LazyTool(module_name, name), tool["parallel_safe"])
+                    for name, tool in cached["tools"].items()
+                }
+                continue
+
+            try:
+                module_tools[module_name] = load_module(file)
+                record_module(module_name, digest, module_tools[module_name])
+                imported += 1
+            except Exception:
+                uprint(f"[TOOLS] failed to load {file.name}:\n{traceback.format_exc()}", OutGoingDataType.LOG)
+
+        write_manifest()
+        snapshot = snapshot_registry()
+
+    swap_registry(snapshot)
+    return imported
+
+def load_tools():
+    global manifest
+    start = time.perf_counter()
+
+    manifest = read_manifest()
+    files = sorted(TOOLS_DIR.glob("*.py"))
+    # Entries of tool files that no longer exist
+    for module_name in set(manifest) - {file.stem for file in files}:
+        manifest.pop(module_name)
+    imported = reload_modules(files, lazy=True)
+
+    elapsed = (time.perf_counter() - start) * 1000
+    uprint(f"[TOOLS] {len(tool_functions)} tools ready in {elapsed:.0f}ms, imported {imported} of {len(files)} modules", OutGoingDataType.LOG)
     return tool_definitions, tool_functions
 
 
+# An editor save fires several events (write, truncate, rename...), changed files are collected
+# and reloaded together once no event arrived for TOOL_RELOAD_DEBOUNCE seconds.
 class ToolChangeHandler(FileSystemEventHandler):
     def __init__(self, on_reload):
         self.on_reload = on_reload
+        self.changed = set()
+        self.timer = None
+        self.lock = threading.Lock()
 
     def on_any_event(self, event):
-        if event.src_path.endswith(".py"):
-            self.on_reload()
+        # Opening a file to import it fires events too, only actual changes count
+        if event.is_directory or event.event_type not in ("created", "modified", "deleted", "moved"):
+            return
+
+        paths = [event.src_path, getattr(event, "dest_path", "")]
+        files = {Path(p) for p in paths if p and p.endswith(".py") and Path(p).parent == TOOLS_DIR}
+        if not files:
+            return
+
+        with self.lock:
+            self.changed |= files
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(TOOL_RELOAD_DEBOUNCE, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            files, self.changed = sorted(self.changed), set()
+            self.timer = None
+        self.on_reload(files)
 
 
-def start_file_watcher(on_reload):
+def start_file_watcher(on_reload=reload_modules):
     event_handler = ToolChangeHandler(on_reload)
     observer = Observer()
     observer.schedule(event_handler, str(TOOLS_DIR), recursive=False)
+    # The same observer keeps the workspace index (directory_tree, find_files, search_files) current
+    workspace_index.watch(observer)
     observer.start()
     return observer
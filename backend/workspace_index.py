@@ -0,0 +1,380 @@
+import os
+import threading
+import time
+
+from watchdog.events import FileSystemEventHandler
+
+from config import BASE_PATH, WORKSPACE_INDEX_MAX_FILE_BYTES, WORKSPACE_INDEX_MAX_FILES, WORKSPACE_INDEX_MAX_TOTAL_BYTES
+from uprint import OutGoingDataType, uprint
+
+# In-memory index of the workspace (BASE_PATH), used by directory_tree, find_files and search_files.
+#
+# The tree is scanned once with os.scandir on first use and then kept current by watches on the
+# observer in watcher.py, so listing or finding files never walks the disk again. Content search
+# uses a trigram index: every text file maps to the set of 3 character sequences in it, and only
+# files containing all trigrams of the query are opened to find the matching lines. A changed file
+# is only marked stale, its trigrams are recomputed by the next content search.
+#
+# Generated directories (virtualenvs, node_modules, the chroma index...) are neither indexed nor
+# watched. A recursive watch can't leave out a subdirectory, so a directory that directly contains
+# one is watched on its own and each of its other subdirectories gets its own watch.
+ROOT = os.path.abspath(BASE_PATH)
+EXCLUDE_DIRS = {"node_modules", ".git", "dist", "build", "__pycache__", "venv", ".venv", ".mypy_cache", ".pytest_cache", ".tox"}
+EXCLUDE_PATHS = {"storage/chroma_index"} # relative to the workspace
+# Small enough to stay under a recursive watch (its events are ignored), instead of splitting every
+# package directory into a watch of its own
+WATCHED_EXCLUDES = {"__pycache__"}
+# Never content searched
+BINARY_SUFFIXES = (
+    ".db", ".sqlite", ".sqlite3", "-wal", "-shm", ".pyc", ".so", ".dll", ".exe", ".bin", ".zip", ".gz",
+    ".png", ".jpg", ".jpeg", ".gif", ".ico", ".webp", ".pdf", ".mp3", ".mp4", ".wav",
+)
+
+lock = threading.RLock()
+built = False
+dirs = {} # relative dir path ("" is the root) -> {name: is_dir}
+file_count = 0 # files in dirs, at most WORKSPACE_INDEX_MAX_FILES
+stale = set() # files whose trigrams are recomputed before the next content search
+file_trigrams = {} # relative file path -> set of trigrams, text files only
+file_sizes = {} # relative file path -> bytes under the trigram index
+indexed_bytes = 0 # at most WORKSPACE_INDEX_MAX_TOTAL_BYTES
+postings = {} # trigram -> set of relative file paths
+warned = set()
+
+observer = None
+handler = None
+watches = {} # relative dir path -> (ObservedWatch, recursive)
+pruned = set() # directories that directly contain an excluded directory, never watched recursively
+
+# Path relative to the workspace with "/" separators, or None when it is outside of it
+def relative(path) -> str:
+    rel = os.path.relpath(os.path.abspath(path), ROOT)
+    if rel == os.curdir:
+        return ""
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        return None
+    return rel.replace(os.sep, "/")
+
+def join(rel: str, name: str) -> str:
+    return f"{rel}/{name}" if rel else name
+
+def split(rel: str):
+    parent, _, name = rel.rpartition("/")
+    return parent, name
+
+def excluded(parent: str, name: str) -> bool:
+    return name in EXCLUDE_DIRS or join(parent, name) in EXCLUDE_PATHS
+
+def ignored(rel: str) -> bool:
+    if rel is None:
+        return True
+    return any(part in EXCLUDE_DIRS for part in rel.split("/")) or any(rel == path or rel.startswith(path + "/") for path in EXCLUDE_PATHS)
+
+def trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def warn_once(message: str):
+    if message not in warned:
+        warned.add(message)
+        uprint(f"[WORKSPACE] {message}", OutGoingDataType.LOG)
+
+def add_file(parent: str, name: str):
+    global file_count
+    if file_count >= WORKSPACE_INDEX_MAX_FILES:
+        warn_once(f"more than {WORKSPACE_INDEX_MAX_FILES} files, the rest of the workspace isn't indexed")
+        return
+    dirs[parent][name] = False
+    file_count += 1
+    stale.add(join(parent, name))
+
+# Scans a directory and everything below it into the index
+def scan(rel: str):
+    pending = [rel]
+    while pending:
+        current = pending.pop()
+        dirs[current] = {}
+        try:
+            with os.scandir(os.path.join(ROOT, current)) as it:
+                for entry in it:
+                    if excluded(current, entry.name):
+                        if entry.name not in WATCHED_EXCLUDES:
+                            pruned.add(current)
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs[current][entry.name] = True
+                        pending.append(join(current, entry.name))
+                    else:
+                        add_file(current, entry.name)
+        except OSError:
+            pass
+
+def forget_file(rel: str):
+    global indexed_bytes
+    stale.discard(rel)
+    indexed_bytes -= file_sizes.pop(rel, 0)
+    for trigram in file_trigrams.pop(rel, ()):
+        paths = postings.get(trigram)
+        if paths is not None:
+            paths.discard(rel)
+            if not paths:
+                del postings[trigram]
+
+def drop(rel: str):
+    global file_count
+    parent, name = split(rel)
+    is_dir = dirs.get(parent, {}).pop(name, None)
+    if is_dir is False:
+        file_count -= 1
+    if not is_dir and rel not in dirs:
+        forget_file(rel)
+        return
+
+    unwatch(rel)
+    pending = [rel]
+    while pending:
+        current = pending.pop()
+        pruned.discard(current)
+        for child, child_is_dir in dirs.pop(current, {}).items():
+            path = join(current, child)
+            if child_is_dir:
+                pending.append(path)
+            else:
+                file_count -= 1
+                forget_file(path)
+
+def add(rel: str):
+    path = os.path.join(ROOT, rel)
+    if not os.path.lexists(path):
+        return
+    parent, name = split(rel)
+    if parent not in dirs:
+        # Scanning the new parent picks this entry up too
+        if not ignored(parent):
+            add(parent)
+        return
+
+    is_dir = os.path.isdir(path) and not os.path.islink(path)
+    known = dirs[parent].get(name)
+    if known is False and not is_dir:
+        stale.add(rel)
+        return
+    if known is not None:
+        drop(rel)
+
+    if is_dir:
+        dirs[parent][name] = True
+        scan(rel)
+        # Under a recursive watch it is already covered
+        if parent in watches and not watches[parent][1]:
+            watch_tree(rel)
+    else:
+        add_file(parent, name)
+
+def ensure_built():
+    global built
+    with lock:
+        if built:
+            return
+        start = time.perf_counter()
+        scan("")
+        built = True
+        watch_tree("")
+        elapsed = (time.perf_counter() - start) * 1000
+        uprint(f"[WORKSPACE] indexed {file_count} files in {len(dirs)} directories in {elapsed:.0f}ms, {len(watches)} watches", OutGoingDataType.LOG)
+
+# Recomputes the trigrams of changed files, binary and oversized files are left out
+def refresh_stale():
+    global indexed_bytes
+    for rel in list(stale):
+        forget_file(rel)
+        if rel.lower().endswith(BINARY_SUFFIXES):
+            continue
+        try:
+            with open(os.path.join(ROOT, rel), "rb") as f:
+                data = f.read(WORKSPACE_INDEX_MAX_FILE_BYTES + 1)
+        except OSError:
+            continue
+        if len(data) > WORKSPACE_INDEX_MAX_FILE_BYTES or b"\0" in data[:8192]:
+            continue
+        if indexed_bytes + len(data) > WORKSPACE_INDEX_MAX_TOTAL_BYTES:
+            warn_once(f"more than {WORKSPACE_INDEX_MAX_TOTAL_BYTES} bytes of text, some files aren't content searched")
+            continue
+
+        grams = trigrams(data.decode("utf-8", errors="ignore").lower())
+        file_trigrams[rel] = grams
+        file_sizes[rel] = len(data)
+        indexed_bytes += len(data)
+        for trigram in grams:
+            postings.setdefault(trigram, set()).add(rel)
+
+# Watches rel, recursively unless an excluded directory is somewhere below it. Then rel itself is
+# watched on its own and the same is done for each of its subdirectories.
+def watch_tree(rel: str):
+    if observer is None:
+        return
+    pending = [rel]
+    while pending:
+        current = pending.pop()
+        split_up = any(path == current or path.startswith(current + "/") or current == "" for path in pruned)
+        try:
+            watches[current] = (observer.schedule(handler, os.path.join(ROOT, current), recursive=not split_up), not split_up)
+        except OSError:
+            continue # Removed in the meantime, its parent's watch reports that
+        if split_up:
+            pending.extend(join(current, name) for name, is_dir in dirs.get(current, {}).items() if is_dir)
+
+def unwatch(rel: str):
+    for path in [path for path in watches if path == rel or path.startswith(rel + "/") or rel == ""]:
+        watch, _ = watches.pop(path)
+        try:
+            observer.unschedule(watch)
+        except (KeyError, OSError):
+            pass
+
+# An excluded directory showed up (e.g. a new virtualenv), the recursive watch covering it is split up
+def exclude_created(parent: str):
+    pruned.add(parent)
+    covering = parent
+    while covering not in watches and covering:
+        covering = split(covering)[0]
+    if covering in watches and watches[covering][1]:
+        unwatch(covering)
+        watch_tree(covering)
+
+# Starts keeping the index current with watches on observer (the one in watcher.py)
+def watch(workspace_observer):
+    global observer, handler
+    with lock:
+        observer = workspace_observer
+        handler = WorkspaceEventHandler()
+        if built:
+            watch_tree("")
+
+# Sorted (name, is_dir) entries of a directory. Served from the index inside the workspace, read
+# from disk for paths outside of it or excluded from it.
+def list_dir(path) -> list:
+    rel = relative(path)
+    if rel is not None:
+        with lock:
+            ensure_built()
+            entries = dirs.get(rel)
+            if entries is not None:
+                return sorted(entries.items())
+
+    try:
+        with os.scandir(path) as it:
+            return sorted((entry.name, entry.is_dir()) for entry in it if entry.name not in EXCLUDE_DIRS)
+    except OSError:
+        return []
+
+# Greedy subsequence match of term in path, None when it doesn't match. Characters that continue a
+# run, start a word or fall in the file name score higher, and so does the term appearing as is in
+# the file name.
+def fuzzy_score(term: str, path: str):
+    name_start = path.rfind("/") + 1
+    score = 0
+    last = None
+    for char in term:
+        i = path.find(char, 0 if last is None else last + 1)
+        if i < 0:
+            return None
+        score += 1
+        if last is not None and i == last + 1:
+            score += 4
+        if i == 0 or path[i - 1] in "/_-. ":
+            score += 3
+        if i >= name_start:
+            score += 2
+        last = i
+    if term in path[name_start:]:
+        score += 2 * len(term)
+    return score
+
+# Paths matching every word of query, best first. Directories end with "/".
+def find(query: str, limit: int) -> list:
+    terms = query.lower().split()
+    with lock:
+        ensure_built()
+        paths = [join(rel, name) + ("/" if is_dir else "") for rel, entries in dirs.items() for name, is_dir in entries.items()]
+
+    scored = []
+    for path in paths:
+        lowered = path.lower()
+        score = 0
+        for term in terms:
+            term_score = fuzzy_score(term, lowered)
+            if term_score is None:
+                break
+            score += term_score
+        else:
+            scored.append((-score, len(path), path))
+
+    scored.sort()
+    return [path for _, _, path in scored[:limit]]
+
+# Lines containing query (case insensitive) in text files under path, as "file:line: text".
+# Returns (matches, whether there were more than limit).
+def search(query: str, path, limit: int):
+    needle = query.lower()
+    prefix = relative(path)
+    if not needle or ignored(prefix):
+        return [], False
+
+    with lock:
+        ensure_built()
+        refresh_stale()
+        if len(needle) >= 3:
+            # Smallest posting lists first, the intersection only shrinks from there
+            grams = sorted((postings.get(trigram, set()) for trigram in trigrams(needle)), key=len)
+            candidates = set(grams[0]).intersection(*grams[1:])
+        else:
+            candidates = set(file_trigrams)
+
+    if prefix:
+        candidates = {rel for rel in candidates if rel == prefix or rel.startswith(prefix + "/")}
+
+    matches = []
+    for rel in sorted(candidates):
+        try:
+            with open(os.path.join(ROOT, rel), encoding="utf-8", errors="ignore") as f:
+                for number, line in enumerate(f, 1):
+                    if needle in line.lower():
+                        if len(matches) == limit:
+                            return matches, True
+                        matches.append(f"{rel}:{number}: {line.strip()[:200]}")
+        except OSError:
+            continue
+    return matches, False
+
+
+# Applies file system events to the index. Watches only exist once the index is built.
+class WorkspaceEventHandler(FileSystemEventHandler):
+    def on_any_event(self, event):
+        if event.event_type not in ("created", "modified", "deleted", "moved"):
+            return
+
+        src = relative(event.src_path)
+        with lock:
+            if not built:
+                return
+            if event.event_type == "modified":
+                # A directory's own modified event only means its entries changed, those have their own events
+                if not ignored(src):
+                    parent, name = split(src)
+                    if dirs.get(parent, {}).get(name) is False:
+                        stale.add(src)
+                return
+            if ignored(src):
+                parent, name = split(src) if src else ("", "")
+                if event.event_type == "created" and event.is_directory and excluded(parent, name) \
+                        and name not in WATCHED_EXCLUDES and parent in dirs:
+                    exclude_created(parent)
+            elif event.event_type == "created":
+                add(src)
+            else:
+                drop(src)
+            if event.event_type == "moved":
+                dest = relative(event.dest_path)
+                if not ignored(dest):
+                    drop(dest)
+                    add(dest)
@@ -98,6 +98,24 @@ export default function App() {
     }
   }
 
+  function handleChatDeltas(data: IncomingData) {
+    if (data.type === "chat-touched") {
+      const touched = data.payload as unknown as Chat;
+      setChats(prev => {
+        const existing = prev.find(chat => chat.id === touched.id);
+        return [{ ...touched, active: existing?.active ?? false }, ...prev.filter(chat => chat.id !== touched.id)];
+      });
+    }
+    else if (data.type === "chat-renamed") {
+      const renamed = data.payload as unknown as { id: number, name: string };
+      setChats(prev => prev.map(chat => chat.id === renamed.id ? { ...chat, name: renamed.name } : chat));
+    }
+    else if (data.type === "chat-deleted") {
+      const deleted = data.payload as unknown as { id: number };
+      setChats(prev => prev.filter(chat => chat.id !== deleted.id));
+    }
+  }
+
   function handleReturnCurrentChatId(data: IncomingData) {
     if(data.type === "return-current-chat-id") {
       const id = Number(data.payload);
@@ -167,6 +185,7 @@ export default function App() {
 
       handleToolWindow(data)
       handleReturnAllChats(data)
+      handleChatDeltas(data)
       handleReturnCurrentChatId(data)
       handlePrompt(data)
 
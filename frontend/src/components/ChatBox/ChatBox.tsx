@@ -52,6 +52,30 @@ export default function ChatBox({sendData}: {sendData: (type: OutgoingDataType,
         });
       }
 
+      // Streamed replies grow a single bubble, marked with meta.streaming until the done event
+      if (type === "assistant-message-delta") {
+        scrollToBottom.current = true
+
+        setMessages((prev) => {
+          const last = prev[prev.length - 1];
+          if (last && last.type === "assistant-message" && last.meta?.streaming) {
+            return [...prev.slice(0, -1), { ...last, payload: last.payload + customEvent.detail.payload }]
+          }
+          return [...prev, { type: "assistant-message", payload: customEvent.detail.payload, meta: { streaming: true } }]
+        });
+      }
+
+      if (type === "assistant-message-done") {
+        setMessages((prev) => {
+          const last = prev[prev.length - 1];
+          const done: IncomingData = { type: "assistant-message", payload: customEvent.detail.payload }
+          if (last && last.type === "assistant-message" && last.meta?.streaming) {
+            return [...prev.slice(0, -1), done]
+          }
+          return [...prev, done]
+        });
+      }
+
       if (type === "return-chat-messages") {
 
         scrollToBottom.current = true
@@ -1,15 +1,21 @@
 // assistant-message -> LLM Reply
+// assistant-message-delta -> next chunk of a streamed LLM reply
+// assistant-message-done -> full text of a streamed LLM reply, sent once streaming finishes
 // return-chat-messages -> fetched from DB, used to fetch after reload or sync state with backend
 // prompt -> backend asking for api keys
 // tool-call -> llm called a tool
 // tool-return -> llm's tool returned something
 // return-all-chats -> response to "get-all-chats"
+// chat-touched -> a chat was created or modified, payload is the chat and it moves to the top of the list
+// chat-renamed -> payload is { id, name } of the renamed chat
+// chat-deleted -> payload is { id } of the deleted chat
+// tools-changed -> tools/ was reloaded, payload is { added: schema[], changed: schema[], removed: name[] }
 // return-current-chat-id -> response to switch-chat
 // return-chat-messages -> response to switch-chat and get-chat-messages
 // audio-service-response -> response from audio service
 // empheral-response -> backend response to "empheral" message
-export type IncomingDataType = "assistant-message" | "assistant-function" |
-"tool-call" | "tool-return" | "return-all-chats" | "return-current-chat-id" | "prompt" |
+export type IncomingDataType = "assistant-message" | "assistant-message-delta" | "assistant-message-done" | "assistant-function" |
+"tool-call" | "tool-return" | "return-all-chats" | "chat-touched" | "chat-renamed" | "chat-deleted" | "tools-changed" | "return-current-chat-id" | "prompt" |
 "return-chat-messages" | "audio-service-response" | "empheral-response";
 
 export interface IncomingData  {
@@ -26,8 +32,8 @@ export interface IncomingData  {
 // switch-chat -> if payload is null, creates a new chat and returns "return-current-chat-id" and "return-chat-messages", if a chat-id is passed in, backend responds with returns "return-chat-messages"
 // get-all-chats -> gets all the chats: their names, ids, etc.
 // get-current-chat-id -> Gets the current chat id of the backend
-// rename-chat -> payload is new name, meta is chat-id to rename, returns "return-all-chats"
-// rename-chat -> payload is chat-id to delete, returns "return-all-chats"
+// rename-chat -> payload is new name, meta is chat-id to rename, returns "chat-renamed"
+// delete-chat -> payload is chat-id to delete, returns "chat-deleted" and "return-current-chat-id"
 // frontend-audio-service -> request from frontend to audio service
 export type OutgoingDataType = "empheral" | "user-message" | "get-chat-messages" | "return-prompt" |
 "user-function" | "switch-chat" | "get-all-chats" | "get-current-chat-id" | "rename-chat" | "delete-chat" |
@@ -528,7 +528,8 @@ int main()
             close(stdout_pipe[0]);
 
             // Exec python backend with venv
-            execlp("bash", "bash", "-c", "cd backend && source venv/bin/activate && python3 main.py", NULL);
+            // exec, so the SIGTERM sent on shutdown reaches python instead of bash
+            execlp("bash", "bash", "-c", "cd backend && source venv/bin/activate && exec python3 main.py", NULL);
 
             perror("exec failed");
             exit(1);
@@ -642,17 +643,22 @@ int main()
 
     webview_destroy(w);
 
+    // Closing its stdin tells the backend to exit, cleanup_servers gives it time to flush first
+    #ifdef _WIN32
+        CloseHandle(pipeHandles.backendStdinWrite);
+    #else
+        close(pipeHandles.backendStdinWrite);
+    #endif
+
     cleanup_servers();
 
     #ifdef _WIN32
-        CloseHandle(pipeHandles.backendStdinWrite);
         CloseHandle(pipeHandles.backendStdoutRead);
         CloseHandle(pipeHandles.audioStdinWrite);
         CloseHandle(pipeHandles.audioStdoutRead);
         CloseHandle(pi.hProcess);
         CloseHandle(pi.hThread);
     #else
-        close(pipeHandles.backendStdinWrite);
         close(pipeHandles.backendStdoutRead);
         close(pipeHandles.audioStdinWrite);
         close(pipeHandles.audioStdoutRead);
@@ -26,6 +26,31 @@ pid_t frontend_server_pid = 0;
 pid_t audio_service_pid = 0;
 pid_t python_backend_pid = 0;
 
+// How long the python backend gets to flush and close its database before it is force killed
+#define BACKEND_STOP_TIMEOUT_MS 10000
+
+// Returns 1 if the process exited within timeout_ms
+static int wait_for_exit(pid_t pid, int timeout_ms) {
+    #ifdef _WIN32
+    HANDLE process = OpenProcess(SYNCHRONIZE, FALSE, pid);
+    if (process == NULL) {
+        return 1; // Already gone
+    }
+    DWORD result = WaitForSingleObject(process, timeout_ms);
+    CloseHandle(process);
+    return result == WAIT_OBJECT_0;
+    #else
+    for (int waited = 0; waited < timeout_ms; waited += 100) {
+        pid_t done = waitpid(pid, NULL, WNOHANG);
+        if (done == pid || done < 0) {
+            return 1;
+        }
+        usleep(100 * 1000);
+    }
+    return 0;
+    #endif
+}
+
 void cleanup_servers() {
     printf("\nCleaning up servers...\n");
     
@@ -41,12 +66,15 @@ void cleanup_servers() {
         audio_service_pid = 0;
     }
     
-    // Kill python backend (cmd wrapper might not propagate termination)
+    // Stop python backend, it exits by itself once its stdin is closed (see main.c), and is only
+    // force killed (with the cmd wrapper, which might not propagate termination) if it doesn't
     if (python_backend_pid > 0) {
         printf("Stopping python backend (PID: %d)\n", python_backend_pid);
-        char cmd[256];
-        snprintf(cmd, sizeof(cmd), "taskkill /f /pid %d /t 2>nul", python_backend_pid);
-        system(cmd);
+        if (!wait_for_exit(python_backend_pid, BACKEND_STOP_TIMEOUT_MS)) {
+            char cmd[256];
+            snprintf(cmd, sizeof(cmd), "taskkill /f /pid %d /t 2>nul", python_backend_pid);
+            system(cmd);
+        }
         python_backend_pid = 0;
     }
     
@@ -80,11 +108,14 @@ void cleanup_servers() {
         }
     }
     
-    // kill python backend
+    // stop python backend, SIGTERM lets it flush and close its database, SIGKILL if it takes too long
     if (python_backend_pid > 0) {
         printf("Stopping python backend (PID: %d)\n", python_backend_pid);
         kill(python_backend_pid, SIGTERM);
-        waitpid(python_backend_pid, NULL, 0);
+        if (!wait_for_exit(python_backend_pid, BACKEND_STOP_TIMEOUT_MS)) {
+            kill(python_backend_pid, SIGKILL);
+            waitpid(python_backend_pid, NULL, 0);
+        }
         python_backend_pid = 0;
     }
     